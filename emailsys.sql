@@ -36,7 +36,7 @@ CREATE TABLE IF NOT EXISTS attachments (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- Indexes for better performance
-CREATE INDEX idx_ticket_status ON tickets (status);
+CREATE INDEX idx_tickets_status_received ON tickets (status, received_at);
 CREATE INDEX idx_ticket_received_at ON tickets (received_at);
-CREATE INDEX idx_responses_ticket_id ON responses (ticket_id);
+CREATE INDEX idx_responses_ticket_sent_at ON responses (ticket_id, sent_at);
 CREATE INDEX idx_attachments_ticket_id ON attachments (ticket_id);
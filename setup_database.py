@@ -5,18 +5,16 @@ This script creates the database and tables needed for the email support system.
 """
 import os
 import mysql.connector
-from dotenv import load_dotenv
 import sys
 
-# Load environment variables
-load_dotenv()
+# Share the application's database settings (DB_* with MYSQL_* fallbacks)
+from src.config.settings import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
 
-# Get database credentials from environment variables
-MYSQL_HOST = os.getenv("MYSQL_HOST", "localhost")
-MYSQL_PORT = int(os.getenv("MYSQL_PORT", "3306"))
-MYSQL_USER = os.getenv("MYSQL_USER", "email_support")
-MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD", "email_support_pass")
-MYSQL_DATABASE = os.getenv("MYSQL_DATABASE", "email_support_system")
+MYSQL_HOST = DB_HOST
+MYSQL_PORT = DB_PORT
+MYSQL_USER = DB_USER
+MYSQL_PASSWORD = DB_PASSWORD
+MYSQL_DATABASE = DB_NAME
 
 def setup_database():
     """Set up the database using the schema file"""
@@ -12,6 +12,12 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_IMAP_SERVER = os.getenv("EMAIL_IMAP_SERVER")
 EMAIL_IMAP_PORT = int(os.getenv("EMAIL_IMAP_PORT", "993"))
 EMAIL_CHECK_INTERVAL = int(os.getenv("EMAIL_CHECK_INTERVAL", "60"))
+# File used to remember processed Message-IDs across restarts
+EMAIL_SEEN_IDS_FILE = os.getenv("EMAIL_SEEN_IDS_FILE", os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "seen_message_ids.json"))
+# Number of new emails handled (ticket, acknowledgment, AI draft) in parallel
+EMAIL_CALLBACK_WORKERS = int(os.getenv("EMAIL_CALLBACK_WORKERS", "4"))
+# Log level for per-email parsing details (set to DEBUG to trace MIME parts)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # Telegram Settings
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -26,6 +32,14 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 # Free model for classification (structured output)
 OPENROUTER_CLASSIFIER_MODEL = os.getenv("OPENROUTER_CLASSIFIER_MODEL", "google/gemma-3-4b-it:free")
+# File that remembers the category of bulk senders across restarts
+CLASSIFIER_SENDER_CACHE_FILE = os.getenv("CLASSIFIER_SENDER_CACHE_FILE", os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "sender_classifications.json"))
+# Maximum number of emails classified in a single request
+CLASSIFY_BATCH_SIZE = int(os.getenv("CLASSIFY_BATCH_SIZE", "20"))
+# Maximum number of classification requests in flight at once
+CLASSIFY_CONCURRENCY = int(os.getenv("CLASSIFY_CONCURRENCY", "8"))
+# Upper bound on concurrent OpenRouter requests (lowered automatically while the API is throttling)
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "8"))
 # Model for response generation
 OPENROUTER_RESPONSE_MODEL = os.getenv("OPENROUTER_RESPONSE_MODEL", "google/gemma-3-4b-it:free")
 
@@ -38,9 +52,19 @@ RAG_CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "50"))
 AUTO_REPLY_ENABLED = os.getenv("AUTO_REPLY_ENABLED", "true").lower() == "true"
 AUTO_FILTER_ENABLED = os.getenv("AUTO_FILTER_ENABLED", "true").lower() == "true"
 
-# MySQL Settings
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_PORT = int(os.getenv("DB_PORT", "3306"))
-DB_USER = os.getenv("DB_USER", "email_support")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "secure_password")
-DB_NAME = os.getenv("DB_NAME", "email_support") 
\ No newline at end of file
+# MySQL Settings (MYSQL_* names are still accepted as fallbacks for older .env files)
+DB_HOST = os.getenv("DB_HOST", os.getenv("MYSQL_HOST", "localhost"))
+DB_PORT = int(os.getenv("DB_PORT", os.getenv("MYSQL_PORT", "3306")))
+DB_USER = os.getenv("DB_USER", os.getenv("MYSQL_USER", "email_support"))
+DB_PASSWORD = os.getenv("DB_PASSWORD", os.getenv("MYSQL_PASSWORD", "secure_password"))
+DB_NAME = os.getenv("DB_NAME", os.getenv("MYSQL_DATABASE", "email_support"))
+# Connection pool size (mysql-connector caps pools at 32 connections)
+DB_POOL_SIZE = min(32, int(os.getenv("DB_POOL_SIZE", str(min(32, 2 * (os.cpu_count() or 1))))))
+# Reset session state whenever a connection is returned to the pool (costs a round-trip per checkout)
+DB_POOL_RESET = os.getenv("DB_POOL_RESET", "false").lower() == "true"
+# Seconds to wait for a free pooled connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Reads running longer than this (milliseconds) are killed by the server so they can't hold a pooled connection
+DB_READ_TIMEOUT_MS = int(os.getenv("DB_READ_TIMEOUT_MS", "2000"))
+# Seconds a write waits for a row lock before failing
+DB_LOCK_WAIT_TIMEOUT = int(os.getenv("DB_LOCK_WAIT_TIMEOUT", "5"))
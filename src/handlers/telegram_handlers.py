@@ -1,6 +1,7 @@
 import telebot
 from telebot import types
 import os
+import time
 from datetime import datetime
 from typing import Dict, List
 from ..models.ticket import Ticket
@@ -31,6 +32,9 @@ from ..services.db_service import (
 pending_edits: Dict[int, str] = {}
 pending_replies: Dict[int, str] = {}
 
+# Minimum seconds between edits while a regenerated draft streams in
+STREAM_EDIT_INTERVAL = 1.5
+
 def register_handlers(bot: telebot.TeleBot):
     """Register all Telegram command handlers"""
     
@@ -113,10 +117,27 @@ def register_handlers(bot: telebot.TeleBot):
             # Get RAG context
             context = get_context_for_email(ticket_data["plain_message"])
             
+            # Show the draft as it is written (Telegram allows roughly one edit per second)
+            last_edit = [time.monotonic()]
+            
+            def show_progress(partial: str):
+                if time.monotonic() - last_edit[0] < STREAM_EDIT_INTERVAL:
+                    return
+                last_edit[0] = time.monotonic()
+                try:
+                    bot.edit_message_text(
+                        f"✍️ Writing AI draft for `{ticket_id}`...\n\n{sanitize_telegram_markdown(partial[-500:])}",
+                        call.message.chat.id,
+                        call.message.message_id
+                    )
+                except Exception as e:
+                    print(f"Error showing draft progress: {e}")
+            
             # Generate new response
             new_response = generate_ai_response(
                 customer_query=ticket_data["plain_message"],
-                context=context
+                context=context,
+                on_progress=show_progress
             )
             
             # Store as pending
@@ -725,7 +746,8 @@ def register_handlers(bot: telebot.TeleBot):
             if 'attachments' in ticket and ticket['attachments']:
                 for attachment in ticket['attachments']:
                     file_path = attachment.get('file_path')
-                    if file_path and os.path.exists(file_path):
+                    if file_path:
+                        # send_file_via_telegram reports missing files itself
                         send_file_via_telegram(message.chat.id, file_path, f"Attachment: {attachment['filename']}")
             
         except Exception as e:
@@ -1,11 +1,11 @@
 import sys
 import os
-import time
+import logging
 import threading
 import signal
 import atexit
-from datetime import datetime
-from typing import List, Dict
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional
 
 # Add the src directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -16,10 +16,17 @@ from src.config.settings import (
     OLLAMA_API_URL, OLLAMA_MODEL,
     DB_HOST, DB_NAME,
     AUTO_REPLY_ENABLED, AUTO_FILTER_ENABLED,
-    OPENROUTER_API_KEY, RAG_KNOWLEDGE_DIR
+    OPENROUTER_API_KEY, RAG_KNOWLEDGE_DIR, LOG_LEVEL
 )
 from src.models.ticket import Ticket
-from src.services.email_service import check_new_emails, send_email
+from src.services.email_service import (
+    check_new_emails,
+    send_email,
+    load_seen_message_ids,
+    save_seen_message_ids,
+    shutdown_email_workers,
+    close_mail_connections
+)
 from src.services.ollama_service import test_ollama_connection
 from src.services.telegram_service import (
     initialize_telegram, 
@@ -27,6 +34,8 @@ from src.services.telegram_service import (
     forward_to_telegram,
     forward_to_telegram_with_draft,
     notify_filtered_email,
+    telegram_batcher,
+    filtered_email_batcher,
     set_running_state
 )
 from src.services.db_service import (
@@ -39,23 +48,54 @@ from src.services.db_service import (
 from src.services.openrouter_service import test_openrouter_connection, generate_ai_response
 from src.services.email_classifier_service import (
     classify_email,
+    classify_emails_batch,
+    fast_classify,
+    load_sender_classifications,
+    save_sender_classifications,
+    MAX_CLASSIFY_BATCH_SIZE,
     is_spam_or_promotion,
     needs_response,
     format_classification_summary,
-    EmailCategory
+    EmailCategory,
+    EmailClassification
 )
 from src.services.rag_service import initialize_rag, get_context_for_email
 from src.handlers.telegram_handlers import register_handlers
 
+# Acknowledgment body is static apart from the ticket ID, so build it once
+ACK_HTML_TEMPLATE = """
+    <h1>We've received your support request</h1>
+    <p>Thank you for contacting us. Your support ticket (#{ticket_id}) has been created and our team will respond shortly.</p>
+    <p>Please don't reply to this email as it's automatically generated.</p>
+    """
+
+# Ticket IDs are second-resolution timestamps ("TKT-" + 14 digits fits the VARCHAR(20) id columns);
+# emails handled in the same second take the following seconds instead of a suffix
+_ticket_id_lock = threading.Lock()
+_last_ticket_time: Optional[datetime] = None
+
 # Global state
 running = True
+shutdown_event = threading.Event()
 email_thread = None
 telegram_loop_thread = None
 
-def handle_new_email(from_email: str, subject: str, body: str, plain_body: str, attachments: List[Dict] = None) -> None:
-    """Handle a new email by classifying, creating a ticket, and optionally auto-responding"""
+def new_ticket_id() -> str:
+    """Generate a unique ticket ID (emails are handled on several threads at once)"""
+    global _last_ticket_time
+    with _ticket_id_lock:
+        # Read the clock under the lock and never reuse or step back from the last second handed out
+        ticket_time = datetime.now().replace(microsecond=0)
+        if _last_ticket_time is not None and ticket_time <= _last_ticket_time:
+            ticket_time = _last_ticket_time + timedelta(seconds=1)
+        _last_ticket_time = ticket_time
+    return f"TKT-{ticket_time.strftime('%Y%m%d%H%M%S')}"
+
+def handle_new_email(from_email: str, subject: str, body: str, plain_body: str, attachments: List[Dict] = None,
+                     classification: Optional[EmailClassification] = None) -> None:
+    """Handle a new email by classifying (unless already classified), creating a ticket, and optionally auto-responding"""
     # Generate ticket ID
-    ticket_id = f"TKT-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    ticket_id = new_ticket_id()
     
     print("\n" + "="*50)
     print(f"HANDLING NEW EMAIL: {subject}")
@@ -64,8 +104,9 @@ def handle_new_email(from_email: str, subject: str, body: str, plain_body: str,
     
     # === STEP 1: Classify the email ===
     if AUTO_FILTER_ENABLED:
-        print("\n📊 Classifying email...")
-        classification = classify_email(from_email, subject, plain_body)
+        if classification is None:
+            print("\n📊 Classifying email...")
+            classification = classify_email(from_email, subject, plain_body)
         print(format_classification_summary(classification))
         
         # Check if this is spam/promotion - auto-filter
@@ -130,17 +171,13 @@ def handle_new_email(from_email: str, subject: str, body: str, plain_body: str,
     if AUTO_REPLY_ENABLED and draft_response:
         forward_to_telegram_with_draft(ticket_id, from_email, subject, plain_body, draft_response, attachments)
     else:
-        forward_to_telegram(ticket_id, from_email, subject, plain_body, attachments)
+        telegram_batcher.enqueue(ticket_id, from_email, subject, plain_body, attachments)
     
     print("="*50 + "\n")
 
 def send_acknowledgment(to_email: str, ticket_id: str) -> None:
     """Send an acknowledgment email to the customer"""
-    html_content = f"""
-    <h1>We've received your support request</h1>
-    <p>Thank you for contacting us. Your support ticket (#{ticket_id}) has been created and our team will respond shortly.</p>
-    <p>Please don't reply to this email as it's automatically generated.</p>
-    """
+    html_content = ACK_HTML_TEMPLATE.replace("{ticket_id}", ticket_id)
     
     if send_email(to_email, f"Support Request Received - Ticket #{ticket_id}", html_content):
         update_ticket_status(ticket_id, "acknowledged")
@@ -152,14 +189,24 @@ def cleanup():
     
     print("\nCleaning up resources...")
     running = False
+    shutdown_event.set()
     set_running_state(False)  # Update Telegram service running state
     
     if email_thread and email_thread.is_alive():
         email_thread.join(timeout=5)
+    
+    # Let emails already being handled finish before their Message-IDs are saved
+    shutdown_email_workers()
+    telegram_batcher.flush()  # Deliver any forwards still waiting in the batch
+    filtered_email_batcher.flush()
+    save_seen_message_ids()
+    save_sender_classifications()
         
     if telegram_loop_thread and telegram_loop_thread.is_alive():
         telegram_loop_thread.join(timeout=5)
     
+    close_mail_connections()
+    
     print("Cleanup complete. Exiting.")
 
 def start_background_tasks():
@@ -173,6 +220,7 @@ def start_background_tasks():
     
     # Reset the running flag
     running = True
+    shutdown_event.clear()
     
     # Register cleanup handlers
     atexit.register(cleanup)
@@ -180,7 +228,21 @@ def start_background_tasks():
     signal.signal(signal.SIGTERM, lambda sig, frame: (cleanup(), sys.exit(0)))
     
     # Start email checking thread
-    email_thread = threading.Thread(target=check_new_emails, args=(handle_new_email,), daemon=True)
+    # With filtering on, each sweep's emails are classified in batches (in the background,
+    # while fetching continues) before being handled
+    email_thread = threading.Thread(
+        target=check_new_emails,
+        args=(handle_new_email,),
+        kwargs={
+            "classify_batch": classify_emails_batch if AUTO_FILTER_ENABLED else None,
+            "batch_size": MAX_CLASSIFY_BATCH_SIZE,
+            # Bulk and automated mail is recognized from its headers without a model call
+            "prefilter": fast_classify if AUTO_FILTER_ENABLED else None,
+            # Emails filtered out from their headers alone are never downloaded in full
+            "discard": is_spam_or_promotion,
+        },
+        daemon=True
+    )
     email_thread.start()
     
     # Start Telegram polling loop
@@ -189,6 +251,7 @@ def start_background_tasks():
 
 def main():
     """Main entry point for the application"""
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     try:
         print("\n" + "="*50)
         print("📧 EMAIL SUPPORT SYSTEM STARTING 📧")
@@ -213,6 +276,12 @@ def main():
             print("Failed to validate database schema. Exiting.")
             return
         
+        # Restore processed Message-IDs so restarts don't duplicate tickets
+        seen_count = load_seen_message_ids()
+        print(f"Loaded {seen_count} processed Message-IDs")
+        sender_count = load_sender_classifications()
+        print(f"Loaded {sender_count} remembered sender classifications")
+        
         # Initialize RAG service
         print("Initializing RAG service...")
         initialize_rag()
@@ -237,9 +306,8 @@ def main():
         
         print("System running! Press Ctrl+C to stop.")
         
-        # Keep the main thread alive
-        while running:
-            time.sleep(1)
+        # Keep the main thread alive until cleanup() signals shutdown
+        shutdown_event.wait()
             
     except KeyboardInterrupt:
         print("\nShutdown requested...")
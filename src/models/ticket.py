@@ -1,18 +1,19 @@
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, Optional, List
+from typing import Dict, Optional
 from ..services.db_service import get_ticket, get_all_tickets, get_recent_tickets
 
+@dataclass(slots=True)
 class Ticket:
-    def __init__(self, ticket_id: str, from_email: str, subject: str, message: str, plain_message: str):
-        self.ticket_id = ticket_id
-        self.from_email = from_email
-        self.subject = subject
-        self.message = message
-        self.plain_message = plain_message
-        self.status = "received"
-        self.received_at = datetime.now().isoformat()
-        self.response: Optional[str] = None
-        self.response_time: Optional[str] = None
+    ticket_id: str
+    from_email: str
+    subject: str
+    message: str
+    plain_message: str
+    status: str = "received"
+    received_at: Optional[str] = field(default_factory=lambda: datetime.now().isoformat())
+    response: Optional[str] = None
+    response_time: Optional[str] = None
 
     def to_dict(self) -> Dict:
         return {
@@ -30,22 +31,21 @@ class Ticket:
     @classmethod
     def from_dict(cls, data: Dict) -> 'Ticket':
         """Create a Ticket instance from a dictionary (database record)"""
-        ticket = cls(
+        return cls(
             ticket_id=data["id"],
             from_email=data["from_email"],
             subject=data["subject"],
-            message=data["message"],
-            plain_message=data["plain_message"]
+            message=data.get("message", ""),
+            plain_message=data.get("plain_message", ""),
+            status=data.get("status", "received"),
+            received_at=data.get("received_at"),
+            response=data.get("response"),
+            response_time=data.get("response_time")
         )
-        ticket.status = data.get("status", "received")
-        ticket.received_at = data.get("received_at")
-        ticket.response = data.get("response")
-        ticket.response_time = data.get("response_time")
-        return ticket
 
     @classmethod
     def get_by_id(cls, ticket_id: str) -> Optional['Ticket']:
-        """Get a ticket by ID from the database"""
+        """Get a ticket by ID (get_ticket caches and invalidates on writes)"""
         ticket_data = get_ticket(ticket_id)
         if ticket_data:
             return cls.from_dict(ticket_data)
@@ -62,9 +62,9 @@ class Ticket:
     
     @classmethod
     def get_recent(cls, limit: int = 10) -> Dict[str, 'Ticket']:
-        """Get recent tickets from the database as a dictionary"""
+        """Get recent tickets from the database as a dictionary (get_recent_tickets caches briefly)"""
         tickets_data = get_recent_tickets(limit)
         return {
             ticket["id"]: cls.from_dict(ticket) 
             for ticket in tickets_data
-        } 
\ No newline at end of file
+        }
@@ -1,13 +1,23 @@
 import mysql.connector
 from mysql.connector import pooling
-from typing import Dict, List, Tuple, Optional, Any
-from datetime import datetime
+from mysql.connector.errors import PoolError
+from contextlib import contextmanager
+import logging
+from collections import OrderedDict
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple, Optional, Any
 import json
 from ..config.settings import (
     DB_HOST, DB_PORT, DB_USER, 
-    DB_PASSWORD, DB_NAME
+    DB_PASSWORD, DB_NAME,
+    DB_POOL_SIZE, DB_POOL_RESET, DB_POOL_TIMEOUT,
+    DB_READ_TIMEOUT_MS, DB_LOCK_WAIT_TIMEOUT
 )
 
+# Per-query tracing goes to a debug logger so normal runs don't pay for it
+logger = logging.getLogger(__name__)
+
 # Create a connection pool
 db_config = {
     'host': DB_HOST,
@@ -16,24 +26,73 @@ db_config = {
     'password': DB_PASSWORD,
     'database': DB_NAME,
     'auth_plugin': 'caching_sha2_password',  # MySQL 8.0+ default auth
+    'use_pure': False,  # Use the C extension for protocol parsing and row decoding
+    'autocommit': True,  # Single statements commit themselves; multi-statement writes use db_connection(transaction=True)
 }
 
 # Initialize the connection pool with a small set of connections
 connection_pool = None
 
+# Optimizer hint for SELECTs on request paths: the server aborts the statement once the
+# budget is spent, so a slow read fails fast instead of tying up a pooled connection
+READ_TIMEOUT_HINT = f"/*+ MAX_EXECUTION_TIME({DB_READ_TIMEOUT_MS}) */"
+
+# Columns needed by list views; the LONGTEXT bodies are only fetched for a single ticket.
+# Timestamps are formatted by MySQL ("YYYY-MM-DD HH:MM:SS", readable by datetime.fromisoformat),
+# so ORDER BY/WHERE must qualify them as tickets.<column> to use the real DATETIME column.
+TICKET_SUMMARY_COLUMNS = (
+    "id, from_email, subject, status, "
+    "CAST(received_at AS CHAR) AS received_at, CAST(response_time AS CHAR) AS response_time"
+)
+TICKET_COLUMNS = (
+    f"{TICKET_SUMMARY_COLUMNS}, message, plain_message, "
+    "CAST(created_at AS CHAR) AS created_at, CAST(updated_at AS CHAR) AS updated_at"
+)
+
+# Secondary indexes checked by ensure_db_schema: {table: {index_name: columns}}
+SCHEMA_INDEXES = {
+    # Serves "tickets in status X, oldest/newest first" as a range scan already in order
+    "tickets": {"idx_tickets_status_received": "(status, received_at)"},
+    # Lets the "latest response" lookup in get_ticket read the newest row straight from the index
+    "responses": {"idx_responses_ticket_sent_at": "(ticket_id, sent_at)"},
+}
+# Indexes made redundant by SCHEMA_INDEXES (a left prefix of a composite index), dropped when found.
+# Older schemas created the status-only index as idx_tickets_status (here) or idx_ticket_status (emailsys.sql),
+# and emailsys.sql created idx_responses_ticket_id. The composite indexes are created first, so the
+# responses foreign key always keeps an index starting with ticket_id.
+SUPERSEDED_INDEXES = {
+    "tickets": ("idx_tickets_status", "idx_ticket_status"),
+    "responses": ("idx_responses_ticket_id",),
+}
+
+# Read-through cache for get_ticket: {ticket_id: (cached_at, ticket)}
+TICKET_CACHE_SIZE = 1024
+TICKET_CACHE_TTL = 60.0
+_ticket_cache: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+_ticket_cache_lock = threading.Lock()
+# Short-lived cache for the newest-tickets list: {limit: (fetched_at, tickets)}, guarded by the same lock
+RECENT_CACHE_TTL = 5.0
+_recent_cache: Dict[int, Tuple[float, List[Dict]]] = {}
+
+# Maximum number of attachment rows sent in a single INSERT batch
+ATTACHMENT_INSERT_BATCH_SIZE = 500
+
 def initialize_db():
     """Initialize the database connection pool"""
     global connection_pool
     try:
         connection_pool = pooling.MySQLConnectionPool(
             pool_name="email_support_pool",
-            pool_size=5,
+            pool_size=DB_POOL_SIZE,
+            pool_reset_session=DB_POOL_RESET,
             **db_config
         )
-        print(f"Database connection pool initialized: {DB_HOST}:{DB_PORT}")
+        print(f"Database connection pool initialized: {DB_HOST}:{DB_PORT} ({DB_POOL_SIZE} connections)")
         
         # Test the connection by getting a connection from the pool
         connection = connection_pool.get_connection()
+        if not mysql.connector.HAVE_CEXT:
+            print("⚠️ MySQL C extension not available, falling back to the pure Python driver")
         connection.close()
         return True
     except Exception as e:
@@ -45,354 +104,439 @@ def get_connection():
     global connection_pool
     if connection_pool is None:
         initialize_db()
-    return connection_pool.get_connection()
+    
+    # The pool raises immediately when exhausted, so wait briefly for a connection to be returned
+    deadline = time.monotonic() + DB_POOL_TIMEOUT
+    warned = False
+    while True:
+        try:
+            connection = connection_pool.get_connection()
+            break
+        except PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            if not warned:
+                print(f"⚠️ Database connection pool exhausted ({DB_POOL_SIZE} connections), waiting...")
+                warned = True
+            time.sleep(0.05)
+    
+    try:
+        prepare_session(connection)
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+def prepare_session(connection):
+    """Apply per-session settings once per server session (every checkout if DB_POOL_RESET is on)"""
+    raw_connection = getattr(connection, '_cnx', connection)
+    if not DB_POOL_RESET and getattr(raw_connection, '_session_prepared', None) == raw_connection.connection_id:
+        return
+    cursor = raw_connection.cursor()
+    cursor.execute(f"SET SESSION innodb_lock_wait_timeout = {int(DB_LOCK_WAIT_TIMEOUT)}")
+    cursor.close()
+    raw_connection._session_prepared = raw_connection.connection_id
+
+def get_prepared_cursor(connection, query: str, dictionary: bool = False):
+    """
+    Get a server-side prepared cursor for a statement.
+    Cursors are kept on the underlying pooled connection, so each statement is
+    parsed and planned once per connection and later calls only send the
+    binary EXECUTE. Callers must consume all rows and must not close the cursor.
+    When DB_POOL_RESET is on, every checkout discards server-side statements, so a
+    plain cursor is returned instead.
+    """
+    if DB_POOL_RESET:
+        return connection.cursor(dictionary=dictionary)
+    
+    raw_connection = getattr(connection, '_cnx', connection)
+    session_id, cursors = getattr(raw_connection, '_prepared_cursors', (None, {}))
+    if session_id != raw_connection.connection_id:
+        # New server session (first use or reconnect): old statement handles are gone
+        cursors = {}
+        raw_connection._prepared_cursors = (raw_connection.connection_id, cursors)
+    key = (query, dictionary)
+    cursor = cursors.get(key)
+    if cursor is None:
+        cursor = raw_connection.cursor(prepared=True, dictionary=dictionary)
+        cursors[key] = cursor
+    return cursor
+
+@contextmanager
+def db_connection(transaction: bool = False):
+    """
+    Check out a pooled connection for the duration of a block.
+    With transaction=True the block runs in one transaction that is committed on
+    success and rolled back on error. The connection always goes back to the pool.
+    """
+    connection = get_connection()
+    try:
+        if transaction:
+            connection.start_transaction()
+        yield connection
+        if connection.in_transaction:
+            connection.commit()
+    except Exception:
+        if connection.is_connected() and connection.in_transaction:
+            connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+@contextmanager
+def db_cursor(dictionary: bool = False, transaction: bool = False):
+    """Check out a pooled connection and a regular cursor, releasing both afterwards"""
+    with db_connection(transaction=transaction) as connection:
+        cursor = connection.cursor(dictionary=dictionary)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+def invalidate_ticket_cache(ticket_id: str) -> None:
+    """Drop cached data for a ticket (and the recent-tickets lists) after it has been modified"""
+    with _ticket_cache_lock:
+        _ticket_cache.pop(ticket_id, None)
+        _recent_cache.clear()
 
 # Ticket functions
 def save_ticket(ticket_id: str, from_email: str, subject: str, message: str, plain_message: str, attachments: List[Dict] = None) -> bool:
     """Save a new ticket to the database with optional attachments"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor(dictionary=True)
-        
-        query = """
-        INSERT INTO tickets 
-        (id, from_email, subject, message, plain_message, status) 
-        VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        cursor.execute(query, (ticket_id, from_email, subject, message, plain_message, "received"))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        with db_connection() as connection:
+            query = """
+            INSERT INTO tickets 
+            (id, from_email, subject, message, plain_message, status) 
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """
+            cursor = get_prepared_cursor(connection, query)
+            cursor.execute(query, (ticket_id, from_email, subject, message, plain_message, "received"))
         
         # Save attachments if any
         if attachments and len(attachments) > 0:
-            print(f"Saving {len(attachments)} attachments for ticket #{ticket_id}")
+            logger.debug("Saving %d attachments for ticket #%s", len(attachments), ticket_id)
             save_ticket_attachments(ticket_id, attachments)
         
+        invalidate_ticket_cache(ticket_id)
         return True
     except Exception as e:
         print(f"Error saving ticket to database: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return False
 
 def update_ticket_status(ticket_id: str, status: str) -> bool:
     """Update a ticket's status"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        query = "UPDATE tickets SET status = %s WHERE id = %s"
-        cursor.execute(query, (status, ticket_id))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        with db_connection() as connection:
+            query = "UPDATE tickets SET status = %s WHERE id = %s"
+            cursor = get_prepared_cursor(connection, query)
+            cursor.execute(query, (status, ticket_id))
+        invalidate_ticket_cache(ticket_id)
         return True
     except Exception as e:
         print(f"Error updating ticket status: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return False
 
 def delete_ticket(ticket_id: str) -> bool:
     """Permanently delete a ticket and all related data (responses, attachments, drafts)"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        # Delete in order due to foreign key constraints
-        # Delete draft responses
-        cursor.execute("DELETE FROM draft_responses WHERE ticket_id = %s", (ticket_id,))
-        
-        # Delete responses
-        cursor.execute("DELETE FROM responses WHERE ticket_id = %s", (ticket_id,))
-        
-        # Delete attachments
-        cursor.execute("DELETE FROM attachments WHERE ticket_id = %s", (ticket_id,))
-        
-        # Delete the ticket itself
-        cursor.execute("DELETE FROM tickets WHERE id = %s", (ticket_id,))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        with db_connection() as connection:
+            # Responses, attachments and drafts are removed by their ON DELETE CASCADE
+            # foreign keys as part of this single (atomic) statement
+            query = "DELETE FROM tickets WHERE id = %s"
+            cursor = get_prepared_cursor(connection, query)
+            cursor.execute(query, (ticket_id,))
+        
+        invalidate_ticket_cache(ticket_id)
         print(f"✅ Ticket {ticket_id} permanently deleted")
         return True
     except Exception as e:
         print(f"Error deleting ticket: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.rollback()
-            connection.close()
         return False
 
 def save_ticket_response(ticket_id: str, response_text: str) -> bool:
     """Save a response to a ticket"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        # Update the ticket status and response time
-        ticket_query = "UPDATE tickets SET status = %s, response_time = %s WHERE id = %s"
-        cursor.execute(ticket_query, ("responded", datetime.now(), ticket_id))
-        
-        # Save the response in the responses table
-        response_query = "INSERT INTO responses (ticket_id, response_text) VALUES (%s, %s)"
-        cursor.execute(response_query, (ticket_id, response_text))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        with db_cursor(transaction=True) as cursor:
+            # Update the ticket status and save the response in a single round-trip
+            query = """
+            UPDATE tickets SET status = %s, response_time = NOW() WHERE id = %s;
+            INSERT INTO responses (ticket_id, response_text) VALUES (%s, %s)
+            """
+            for _ in cursor.execute(query, ("responded", ticket_id, ticket_id, response_text), multi=True):
+                pass  # Consume every result so the connection is ready for commit
+        invalidate_ticket_cache(ticket_id)
         return True
     except Exception as e:
         print(f"Error saving ticket response: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return False
 
+def _copy_ticket(ticket: Dict) -> Dict:
+    """Copy of a cached ticket that callers can modify, attachments included"""
+    ticket = dict(ticket)
+    ticket['attachments'] = [dict(attachment) for attachment in ticket['attachments']]
+    return ticket
+
 def get_ticket(ticket_id: str) -> Optional[Dict]:
     """Get a ticket by ID with its attachments"""
+    with _ticket_cache_lock:
+        cached = _ticket_cache.get(ticket_id)
+        if cached and time.monotonic() - cached[0] < TICKET_CACHE_TTL:
+            _ticket_cache.move_to_end(ticket_id)
+            return _copy_ticket(cached[1])
+    
     try:
-        print(f"Fetching ticket #{ticket_id} from database")
-        connection = get_connection()
-        cursor = connection.cursor(dictionary=True)
-        
-        # Get the ticket
-        ticket_query = "SELECT * FROM tickets WHERE id = %s"
-        cursor.execute(ticket_query, (ticket_id,))
-        ticket = cursor.fetchone()
+        logger.debug("Fetching ticket #%s from database", ticket_id)
+        with db_cursor(dictionary=True) as cursor:
+            # Get the ticket, its latest response and its attachments in one round-trip
+            query = f"""
+            SELECT {READ_TIMEOUT_HINT} {TICKET_COLUMNS} FROM tickets WHERE id = %s;
+            SELECT {READ_TIMEOUT_HINT} response_text, CAST(sent_at AS CHAR) AS sent_at 
+            FROM responses 
+            WHERE ticket_id = %s 
+            ORDER BY responses.sent_at DESC 
+            LIMIT 1;
+            SELECT {READ_TIMEOUT_HINT} id, filename, file_path, content_type, file_size 
+            FROM attachments 
+            WHERE ticket_id = %s
+            """
+            ticket_rows, response_rows, attachments = [
+                result.fetchall()
+                for result in cursor.execute(query, (ticket_id, ticket_id, ticket_id), multi=True)
+                if result.with_rows
+            ]
         
-        if not ticket:
+        if not ticket_rows:
             print(f"❌ Ticket #{ticket_id} not found in database")
-            cursor.close()
-            connection.close()
             return None
         
-        print(f"✅ Found ticket #{ticket_id} in database")
-        
-        # Get the latest response
-        response_query = """
-        SELECT response_text, sent_at 
-        FROM responses 
-        WHERE ticket_id = %s 
-        ORDER BY sent_at DESC 
-        LIMIT 1
-        """
-        cursor.execute(response_query, (ticket_id,))
-        response = cursor.fetchone()
-        
-        # Get attachments
-        print(f"Fetching attachments for ticket #{ticket_id}")
-        attachments_query = """
-        SELECT id, filename, file_path, content_type, file_size 
-        FROM attachments 
-        WHERE ticket_id = %s
-        """
-        cursor.execute(attachments_query, (ticket_id,))
-        attachments = cursor.fetchall()
-        print(f"Found {len(attachments)} attachment(s) for ticket #{ticket_id}")
-        
-        # Convert datetime objects to ISO format strings for JSON serialization
-        for key, value in ticket.items():
-            if isinstance(value, datetime):
-                ticket[key] = value.isoformat()
+        ticket = ticket_rows[0]
+        response = response_rows[0] if response_rows else None
+        logger.debug("Found ticket #%s with %d attachment(s)", ticket_id, len(attachments))
         
         # Add the response data to the ticket
         if response:
             ticket['response'] = response['response_text']
-            ticket['response_time'] = response['sent_at'].isoformat()
+            ticket['response_time'] = response['sent_at']
         
         # Add attachments to the ticket
         ticket['attachments'] = attachments
-        for i, attachment in enumerate(attachments):
-            print(f"  Attachment {i+1}: {attachment['filename']} ({attachment.get('content_type', 'unknown')}, {attachment.get('file_size', 0)} bytes)")
-            print(f"  File path: {attachment.get('file_path', 'unknown')}")
         
-        cursor.close()
-        connection.close()
-        return ticket
+        with _ticket_cache_lock:
+            _ticket_cache[ticket_id] = (time.monotonic(), ticket)
+            _ticket_cache.move_to_end(ticket_id)
+            if len(_ticket_cache) > TICKET_CACHE_SIZE:
+                _ticket_cache.popitem(last=False)
+        return _copy_ticket(ticket)
     except Exception as e:
         print(f"❌ Error getting ticket: {e}")
         # Print the traceback for more detailed error information
         import traceback
         traceback.print_exc()
-        
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return None
 
-def get_all_tickets() -> List[Dict]:
-    """Get all tickets"""
+def get_ticket_summary(ticket_id: str) -> Optional[Dict]:
+    """Get a ticket's header fields without the message bodies"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor(dictionary=True)
+        with db_connection() as connection:
+            query = f"SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets WHERE id = %s"
+            cursor = get_prepared_cursor(connection, query, dictionary=True)
+            cursor.execute(query, (ticket_id,))
+            rows = cursor.fetchall()  # Drain the result so the cached cursor can be reused
         
+        return rows[0] if rows else None
+    except Exception as e:
+        print(f"Error getting ticket summary: {e}")
+        return None
+
+def iter_all_tickets() -> Iterator[Dict]:
+    """Stream all tickets row by row without materializing the whole result set"""
+    with db_cursor(dictionary=True) as cursor:
         # Get all tickets sorted by received_at descending (newest first)
-        query = "SELECT * FROM tickets ORDER BY received_at DESC"
+        query = f"SELECT {READ_TIMEOUT_HINT} {TICKET_SUMMARY_COLUMNS} FROM tickets ORDER BY tickets.received_at DESC"
         cursor.execute(query)
-        tickets = cursor.fetchall()
-        
-        # Convert datetime objects to ISO format strings for JSON serialization
-        for ticket in tickets:
-            for key, value in ticket.items():
-                if isinstance(value, datetime):
-                    ticket[key] = value.isoformat()
-        
-        cursor.close()
-        connection.close()
-        return tickets
+        try:
+            for ticket in cursor:
+                yield ticket
+        except GeneratorExit:
+            # Caller stopped early: read off the remaining rows so the connection can be reused
+            cursor.fetchall()
+            raise
+
+def get_all_tickets() -> List[Dict]:
+    """Get all tickets"""
+    try:
+        return list(iter_all_tickets())
     except Exception as e:
         print(f"Error getting all tickets: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return []
 
-def get_recent_tickets(limit: int = 10) -> List[Dict]:
-    """Get the most recent tickets"""
+def get_recent_tickets(limit: int = 10, before: Optional[str] = None) -> List[Dict]:
+    """Get the most recent tickets, optionally only those received before a given time (first page cached briefly)"""
+    if not before:
+        with _ticket_cache_lock:
+            cached = _recent_cache.get(limit)
+            if cached and time.monotonic() - cached[0] < RECENT_CACHE_TTL:
+                return [dict(ticket) for ticket in cached[1]]
+    
     try:
-        connection = get_connection()
-        cursor = connection.cursor(dictionary=True)
-        
-        # Get recent tickets sorted by received_at descending (newest first)
-        query = "SELECT * FROM tickets ORDER BY received_at DESC LIMIT %s"
-        cursor.execute(query, (limit,))
-        tickets = cursor.fetchall()
-        
-        # Convert datetime objects to ISO format strings for JSON serialization
-        for ticket in tickets:
-            for key, value in ticket.items():
-                if isinstance(value, datetime):
-                    ticket[key] = value.isoformat()
-        
-        cursor.close()
-        connection.close()
+        with db_cursor(dictionary=True) as cursor:
+            # Get recent tickets sorted by received_at descending (newest first)
+            # Paging uses the received_at index (keyset) instead of scanning past an OFFSET
+            if before:
+                query = f"SELECT {READ_TIMEOUT_HINT} {TICKET_SUMMARY_COLUMNS} FROM tickets WHERE tickets.received_at < %s ORDER BY tickets.received_at DESC LIMIT %s"
+                cursor.execute(query, (before, limit))
+            else:
+                query = f"SELECT {READ_TIMEOUT_HINT} {TICKET_SUMMARY_COLUMNS} FROM tickets ORDER BY tickets.received_at DESC LIMIT %s"
+                cursor.execute(query, (limit,))
+            tickets = cursor.fetchall()
+        
+        if not before:
+            with _ticket_cache_lock:
+                _recent_cache[limit] = (time.monotonic(), tickets)
+            return [dict(ticket) for ticket in tickets]
         return tickets
     except Exception as e:
         print(f"Error getting recent tickets: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return []
 
 # Add a new function to save attachments
 def save_ticket_attachments(ticket_id: str, attachments: List[Dict]) -> bool:
     """Save attachments for a ticket"""
     if not attachments:
-        print(f"No attachments to save for ticket #{ticket_id}")
+        logger.debug("No attachments to save for ticket #%s", ticket_id)
         return True
         
-    print(f"Saving {len(attachments)} attachment(s) for ticket #{ticket_id}")
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        for i, attachment in enumerate(attachments):
-            print(f"Saving attachment {i+1}/{len(attachments)}: {attachment['filename']}")
-            query = """
-            INSERT INTO attachments 
-            (ticket_id, filename, file_path, content_type, file_size) 
-            VALUES (%s, %s, %s, %s, %s)
-            """
-            cursor.execute(query, (
-                ticket_id, 
-                attachment['filename'], 
-                attachment['path'], 
+        query = """
+        INSERT INTO attachments 
+        (ticket_id, filename, file_path, content_type, file_size) 
+        VALUES (%s, %s, %s, %s, %s)
+        """
+        rows = [
+            (
+                ticket_id,
+                attachment['filename'],
+                attachment['path'],
                 attachment.get('content_type', 'application/octet-stream'),
                 attachment.get('size', 0)
-            ))
-            print(f"✅ Attachment {i+1} saved to database: {attachment['filename']}")
+            )
+            for attachment in attachments
+        ]
         
-        connection.commit()
-        cursor.close()
-        connection.close()
-        print(f"All {len(attachments)} attachment(s) saved successfully for ticket #{ticket_id}")
+        with db_cursor(transaction=True) as cursor:
+            # Insert all rows in batches rather than one round-trip per attachment
+            for start in range(0, len(rows), ATTACHMENT_INSERT_BATCH_SIZE):
+                cursor.executemany(query, rows[start:start + ATTACHMENT_INSERT_BATCH_SIZE])
+        
+        invalidate_ticket_cache(ticket_id)
+        logger.debug("Saved %d attachment(s) for ticket #%s", len(attachments), ticket_id)
         return True
     except Exception as e:
         print(f"❌ Error saving attachments: {e}")
         # Print the traceback for more detailed error information
         import traceback
         traceback.print_exc()
-        
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return False
 
 # Database initialization and schema validation
 def ensure_db_schema():
     """Ensure the database schema is properly set up"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        # Check if tables exist
-        cursor.execute("SHOW TABLES")
-        tables = [table[0] for table in cursor.fetchall()]
-        
-        schema_valid = True
-        
-        if 'tickets' not in tables:
-            print("tickets table not found, creating...")
+        with db_cursor() as cursor:
+            # Check if tables exist
+            cursor.execute("SHOW TABLES")
+            tables = [table[0] for table in cursor.fetchall()]
             
-            # Create tickets table
-            cursor.execute("""
-            CREATE TABLE tickets (
-                id VARCHAR(30) PRIMARY KEY,
-                from_email VARCHAR(255) NOT NULL,
-                subject VARCHAR(255) NOT NULL,
-                message LONGTEXT NOT NULL,
-                plain_message LONGTEXT NOT NULL,
-                status VARCHAR(50) NOT NULL DEFAULT 'received',
-                received_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                response_time DATETIME NULL,
-                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
-            )
-            """)
+            schema_valid = True
             
-            # Create index for faster retrieval
-            cursor.execute("CREATE INDEX idx_tickets_status ON tickets(status)")
-            cursor.execute("CREATE INDEX idx_tickets_received_at ON tickets(received_at)")
+            if 'tickets' not in tables:
+                print("tickets table not found, creating...")
+                
+                # Create tickets table
+                cursor.execute("""
+                CREATE TABLE tickets (
+                    id VARCHAR(30) PRIMARY KEY,
+                    from_email VARCHAR(255) NOT NULL,
+                    subject VARCHAR(255) NOT NULL,
+                    message LONGTEXT NOT NULL,
+                    plain_message LONGTEXT NOT NULL,
+                    status VARCHAR(50) NOT NULL DEFAULT 'received',
+                    received_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    response_time DATETIME NULL,
+                    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                )
+                """)
+                
+                # Create index for faster retrieval
+                cursor.execute("CREATE INDEX idx_tickets_received_at ON tickets(received_at)")
+                
+                schema_valid = False
             
-            schema_valid = False
-        
-        if 'responses' not in tables:
-            print("responses table not found, creating...")
+            if 'responses' not in tables:
+                print("responses table not found, creating...")
+                
+                # Create responses table
+                cursor.execute("""
+                CREATE TABLE responses (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    ticket_id VARCHAR(30) NOT NULL,
+                    response_text LONGTEXT NOT NULL,
+                    sent_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
+                )
+                """)
+                
+                schema_valid = False
+                
+            if 'attachments' not in tables:
+                print("attachments table not found, creating...")
+                
+                # Create attachments table
+                cursor.execute("""
+                CREATE TABLE attachments (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    ticket_id VARCHAR(30) NOT NULL,
+                    filename VARCHAR(255) NOT NULL,
+                    file_path VARCHAR(255) NOT NULL,
+                    content_type VARCHAR(100) NOT NULL,
+                    file_size INT NOT NULL,
+                    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
+                )
+                """)
+                
+                schema_valid = False
             
-            # Create responses table
-            cursor.execute("""
-            CREATE TABLE responses (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                ticket_id VARCHAR(30) NOT NULL,
-                response_text LONGTEXT NOT NULL,
-                sent_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
-            )
-            """)
+            if 'drafts' not in tables:
+                print("drafts table not found, creating...")
+                
+                # Create drafts table for AI draft responses awaiting confirmation
+                cursor.execute("""
+                CREATE TABLE drafts (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    ticket_id VARCHAR(30) NOT NULL UNIQUE,
+                    draft_text LONGTEXT NOT NULL,
+                    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
+                )
+                """)
+                
+                schema_valid = False
             
-            schema_valid = False
-            
-        if 'attachments' not in tables:
-            print("attachments table not found, creating...")
-            
-            # Create attachments table
-            cursor.execute("""
-            CREATE TABLE attachments (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                ticket_id VARCHAR(30) NOT NULL,
-                filename VARCHAR(255) NOT NULL,
-                file_path VARCHAR(255) NOT NULL,
-                content_type VARCHAR(100) NOT NULL,
-                file_size INT NOT NULL,
-                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
-            )
-            """)
-            
-            schema_valid = False
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+            # Make sure secondary indexes exist on tables created by older versions too
+            for table, indexes in SCHEMA_INDEXES.items():
+                cursor.execute(f"SHOW INDEX FROM {table}")
+                existing = {row[2] for row in cursor.fetchall()}
+                for index_name, columns in indexes.items():
+                    if index_name not in existing:
+                        print(f"Creating index {index_name} on {table}...")
+                        cursor.execute(f"CREATE INDEX {index_name} ON {table} {columns}")
+                for index_name in SUPERSEDED_INDEXES.get(table, ()):
+                    if index_name in existing:
+                        print(f"Dropping redundant index {index_name} on {table}...")
+                        cursor.execute(f"DROP INDEX {index_name} ON {table}")
         
         if not schema_valid:
             print("Database schema has been initialized")
@@ -400,111 +544,72 @@ def ensure_db_schema():
         return True
     except Exception as e:
         print(f"Error ensuring database schema: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return False
 
 # Add function to get attachments for a ticket
 def get_ticket_attachments(ticket_id: str) -> List[Dict]:
     """Get all attachments for a ticket"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor(dictionary=True)
-        
-        query = """
-        SELECT id, filename, file_path, content_type, file_size 
-        FROM attachments 
-        WHERE ticket_id = %s
-        """
-        cursor.execute(query, (ticket_id,))
-        attachments = cursor.fetchall()
-        
-        cursor.close()
-        connection.close()
+        with db_connection() as connection:
+            query = """
+            SELECT id, filename, file_path, content_type, file_size 
+            FROM attachments 
+            WHERE ticket_id = %s
+            """
+            cursor = get_prepared_cursor(connection, query, dictionary=True)
+            cursor.execute(query, (ticket_id,))
+            attachments = cursor.fetchall()
         return attachments
     except Exception as e:
         print(f"Error getting attachments: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return []
 
 
 def save_draft_response(ticket_id: str, draft_text: str) -> bool:
     """Save a draft AI response for a ticket"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        # Check if drafts table exists, create if not
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS drafts (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                ticket_id VARCHAR(30) NOT NULL UNIQUE,
-                draft_text LONGTEXT NOT NULL,
-                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                FOREIGN KEY (ticket_id) REFERENCES tickets(id) ON DELETE CASCADE
-            )
-        """)
-        
-        # Insert or update draft
-        query = """
-            INSERT INTO drafts (ticket_id, draft_text) 
-            VALUES (%s, %s)
-            ON DUPLICATE KEY UPDATE draft_text = %s, updated_at = CURRENT_TIMESTAMP
-        """
-        cursor.execute(query, (ticket_id, draft_text, draft_text))
+        with db_connection() as connection:
+            # Insert or update draft (the drafts table is created by ensure_db_schema)
+            query = """
+                INSERT INTO drafts (ticket_id, draft_text) 
+                VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE draft_text = VALUES(draft_text), updated_at = CURRENT_TIMESTAMP
+            """
+            cursor = get_prepared_cursor(connection, query)
+            cursor.execute(query, (ticket_id, draft_text))
         
-        connection.commit()
-        cursor.close()
-        connection.close()
         print(f"✅ Saved draft response for ticket #{ticket_id}")
         return True
     except Exception as e:
         print(f"❌ Error saving draft response: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return False
 
 
 def get_draft_response(ticket_id: str) -> Optional[str]:
     """Get the draft AI response for a ticket"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor(dictionary=True)
-        
-        query = "SELECT draft_text FROM drafts WHERE ticket_id = %s"
-        cursor.execute(query, (ticket_id,))
-        result = cursor.fetchone()
-        
-        cursor.close()
-        connection.close()
-        
-        if result:
-            return result['draft_text']
+        with db_connection() as connection:
+            query = "SELECT draft_text FROM drafts WHERE ticket_id = %s"
+            cursor = get_prepared_cursor(connection, query, dictionary=True)
+            cursor.execute(query, (ticket_id,))
+            rows = cursor.fetchall()  # Drain the result so the cached cursor can be reused
+        
+        if rows:
+            return rows[0]['draft_text']
         return None
     except Exception as e:
         print(f"Error getting draft response: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
         return None
 
 
 def delete_draft_response(ticket_id: str) -> bool:
     """Delete the draft response for a ticket after it's been sent"""
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        
-        query = "DELETE FROM drafts WHERE ticket_id = %s"
-        cursor.execute(query, (ticket_id,))
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+        with db_connection() as connection:
+            query = "DELETE FROM drafts WHERE ticket_id = %s"
+            cursor = get_prepared_cursor(connection, query)
+            cursor.execute(query, (ticket_id,))
         return True
     except Exception as e:
         print(f"Error deleting draft response: {e}")
-        if 'connection' in locals() and connection.is_connected():
-            connection.close()
-        return False 
\ No newline at end of file
+        return False
\ No newline at end of file
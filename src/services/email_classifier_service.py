@@ -3,11 +3,20 @@ Email Classification Service
 Uses OpenRouter to classify emails and filter spam/promotions
 """
 import json
-from typing import Dict, Optional, Tuple
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
 from enum import Enum
 from dataclasses import dataclass
 from .openrouter_service import call_openrouter_structured, call_openrouter
-from ..config.settings import OPENROUTER_CLASSIFIER_MODEL
+from ..config.settings import (
+    OPENROUTER_CLASSIFIER_MODEL, CLASSIFY_BATCH_SIZE, CLASSIFY_CONCURRENCY,
+    CLASSIFIER_SENDER_CACHE_FILE
+)
 
 
 class EmailCategory(Enum):
@@ -36,6 +45,260 @@ class EmailClassification:
     suggested_action: str
 
 
+# Emails classified together in one classify_emails_batch request
+MAX_CLASSIFY_BATCH_SIZE = CLASSIFY_BATCH_SIZE
+# Batches this small are cheaper as single requests than as one larger prompt
+BATCH_CLASSIFY_THRESHOLD = 2
+# Header-based rules for bulk and machine-generated mail that needs no model call
+BULK_PRECEDENCE = {"bulk", "list"}
+AUTOMATED_SENDER_PATTERN = re.compile(r'(^|[<\s"])(no-?reply|do-?not-?reply|mailer-daemon|postmaster)[^@]*@', re.IGNORECASE)
+NEWSLETTER_SENDER_PATTERN = re.compile(r'(^|[<\s"])(newsletters?|news|marketing)@', re.IGNORECASE)
+DMARC_REJECT_PATTERN = re.compile(r'dmarc=fail\b[^;]*\bp=reject\b', re.IGNORECASE)
+
+# Start of quoted reply history or a signature; the classifier only needs the new text above it
+QUOTED_HISTORY_PATTERN = re.compile(
+    r'\n(?:>|On [^\n]{0,200}wrote:|-{2,} ?Original Message ?-{2,}|_{5,}|-- ?\n)',
+    re.IGNORECASE
+)
+
+# Categories remembered per sender address (kept across restarts), with how long a decision is
+# trusted. Only bulk categories: a customer's next email may be a different kind of request.
+SENDER_CACHE_TTLS = {
+    EmailCategory.NEWSLETTER: 30 * 24 * 3600,
+    EmailCategory.PROMOTION: 30 * 24 * 3600,
+    EmailCategory.SPAM: 30 * 24 * 3600,
+    EmailCategory.AUTOMATED: 7 * 24 * 3600,
+}
+SENDER_CACHE_MIN_CONFIDENCE = 0.85
+MAX_SENDER_CLASSIFICATIONS = 5000
+# {sender: {"category", "confidence", "priority", "should_delete", "should_archive", "expires_at"}}
+_sender_classifications: "OrderedDict[str, Dict]" = OrderedDict()
+_sender_lock = threading.Lock()
+
+# Results for emails already seen (repeated newsletters/promotions), keyed by a digest of
+# the model name and normalized email fields: {digest: classification}
+CLASSIFICATION_CACHE_SIZE = 4096
+_classification_cache: "OrderedDict[str, EmailClassification]" = OrderedDict()
+_classification_cache_lock = threading.Lock()
+
+CLASSIFIER_SYSTEM_PROMPT = """You are an email classification assistant. Analyze emails and classify them accurately.
+You must respond with valid JSON only, no other text."""
+
+CLASSIFICATION_FIELDS = '''    "category": "support_request" | "promotion" | "spam" | "newsletter" | "automated" | "inquiry" | "complaint" | "feedback" | "other",
+    "confidence": 0.0 to 1.0,
+    "priority": 1 to 5 (1=highest, 5=lowest),
+    "should_respond": true/false,
+    "should_delete": true/false,
+    "should_archive": true/false,
+    "reason": "Brief explanation of classification",
+    "suggested_action": "What to do with this email"'''
+
+# JSON schemas that constrain classifier output (structured outputs), mirroring EmailClassification
+CLASSIFICATION_PROPERTIES = {
+    "category": {"type": "string", "enum": [category.value for category in EmailCategory]},
+    "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+    "priority": {"type": "integer", "minimum": 1, "maximum": 5},
+    "should_respond": {"type": "boolean"},
+    "should_delete": {"type": "boolean"},
+    "should_archive": {"type": "boolean"},
+    "reason": {"type": "string"},
+    "suggested_action": {"type": "string"},
+}
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": CLASSIFICATION_PROPERTIES,
+    "required": list(CLASSIFICATION_PROPERTIES),
+    "additionalProperties": False,
+}
+BATCH_CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, **CLASSIFICATION_PROPERTIES},
+                "required": ["id", *CLASSIFICATION_PROPERTIES],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["results"],
+    "additionalProperties": False,
+}
+# The JSON above needs well under this many tokens per email
+CLASSIFICATION_MAX_TOKENS = 200
+
+CLASSIFICATION_GUIDELINES = """Classification guidelines:
+- promotion/spam/newsletter: should_delete=true or should_archive=true, should_respond=false
+- support_request/inquiry/complaint: should_respond=true, priority 1-3
+- automated: should_archive=true, should_respond=false
+- complaint: priority=1, should_respond=true
+- feedback: priority=3, should_respond=true (acknowledge)"""
+
+
+def _truncate_body(body: str, max_body_len: int = 1500) -> str:
+    """Drop quoted reply history and signature, then truncate an email body (at a word break) for a prompt"""
+    new_text = QUOTED_HISTORY_PATTERN.split(body, maxsplit=1)[0].strip()
+    if new_text:
+        body = new_text
+    if len(body) <= max_body_len:
+        return body
+    cut = body.rfind(" ", 0, max_body_len)
+    return body[:cut if cut > max_body_len // 2 else max_body_len] + "..."
+
+
+def _classification_cache_key(from_email: str, subject: str, body: str) -> str:
+    """Digest of the fields the classifier sees, normalized so trivial whitespace/case changes still match"""
+    normalized = "\x1f".join(
+        re.sub(r"\s+", " ", value).strip().lower()
+        for value in (OPENROUTER_CLASSIFIER_MODEL, from_email, subject, _truncate_body(body))
+    )
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _get_cached_classification(key: str) -> Optional[EmailClassification]:
+    """Return a cached classification, marking it as recently used"""
+    with _classification_cache_lock:
+        classification = _classification_cache.get(key)
+        if classification is not None:
+            _classification_cache.move_to_end(key)
+        return classification
+
+
+def _cache_classification(key: str, classification: EmailClassification) -> None:
+    """Remember a classification, evicting the least recently used entry when full"""
+    with _classification_cache_lock:
+        _classification_cache[key] = classification
+        _classification_cache.move_to_end(key)
+        if len(_classification_cache) > CLASSIFICATION_CACHE_SIZE:
+            _classification_cache.popitem(last=False)
+
+
+def _get_sender_classification(from_email: str) -> Optional[EmailClassification]:
+    """Return the remembered bulk category for a sender, if it hasn't expired"""
+    sender = (from_email or "").strip().lower()
+    with _sender_lock:
+        entry = _sender_classifications.get(sender)
+        if entry is None:
+            return None
+        if entry["expires_at"] < time.time():
+            del _sender_classifications[sender]
+            return None
+    return EmailClassification(
+        category=EmailCategory(entry["category"]),
+        confidence=entry["confidence"],
+        priority=entry["priority"],
+        should_respond=False,
+        should_delete=entry["should_delete"],
+        should_archive=entry["should_archive"],
+        reason="Sender previously classified as " + entry["category"],
+        suggested_action="Same handling as earlier mail from this sender"
+    )
+
+
+def _remember_sender_classification(from_email: str, classification: EmailClassification) -> None:
+    """Remember a confident bulk classification for the sender"""
+    ttl = SENDER_CACHE_TTLS.get(classification.category)
+    if (ttl is None or classification.should_respond
+            or classification.confidence < SENDER_CACHE_MIN_CONFIDENCE or not from_email):
+        return
+    sender = from_email.strip().lower()
+    with _sender_lock:
+        _sender_classifications[sender] = {
+            "category": classification.category.value,
+            "confidence": classification.confidence,
+            "priority": classification.priority,
+            "should_delete": classification.should_delete,
+            "should_archive": classification.should_archive,
+            "expires_at": time.time() + ttl,
+        }
+        _sender_classifications.move_to_end(sender)
+        if len(_sender_classifications) > MAX_SENDER_CLASSIFICATIONS:
+            _sender_classifications.popitem(last=False)
+
+
+def load_sender_classifications() -> int:
+    """Load per-sender classifications saved by a previous run, dropping expired ones"""
+    try:
+        with open(CLASSIFIER_SENDER_CACHE_FILE, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        print(f"Error loading sender classifications: {e}")
+        return 0
+    
+    now = time.time()
+    with _sender_lock:
+        for sender, entry in entries.items():
+            if entry.get("expires_at", 0) > now:
+                _sender_classifications[sender] = entry
+        while len(_sender_classifications) > MAX_SENDER_CLASSIFICATIONS:
+            _sender_classifications.popitem(last=False)
+        return len(_sender_classifications)
+
+
+def save_sender_classifications() -> bool:
+    """Persist per-sender classifications so a restart keeps them"""
+    try:
+        with _sender_lock:
+            entries = dict(_sender_classifications)
+        with open(CLASSIFIER_SENDER_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        return True
+    except Exception as e:
+        print(f"Error saving sender classifications: {e}")
+        return False
+
+
+def _parse_classification(result: Dict) -> Optional[EmailClassification]:
+    """Build an EmailClassification from the model's JSON, or None if it is malformed"""
+    try:
+        return EmailClassification(
+            category=EmailCategory(result.get("category", "other")),
+            confidence=float(result.get("confidence", 0.5)),
+            priority=int(result.get("priority", 3)),
+            should_respond=bool(result.get("should_respond", True)),
+            should_delete=bool(result.get("should_delete", False)),
+            should_archive=bool(result.get("should_archive", False)),
+            reason=str(result.get("reason", "Classification completed")),
+            suggested_action=str(result.get("suggested_action", "Review manually"))
+        )
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Error parsing classification result: {e}")
+        return None
+
+
+def _default_classification() -> EmailClassification:
+    """Default: treat as support request to be safe"""
+    return EmailClassification(
+        category=EmailCategory.OTHER,
+        confidence=0.3,
+        priority=3,
+        should_respond=True,
+        should_delete=False,
+        should_archive=False,
+        reason="Classification failed, defaulting to manual review",
+        suggested_action="Forward for manual review"
+    )
+
+
+def _run_concurrently(func: Callable, args_list: List[Tuple], fallback: Callable) -> List:
+    """Call func(*args) for each entry on worker threads, returning results in input order"""
+    def run(args):
+        try:
+            return func(*args)
+        except Exception as e:
+            print(f"❌ Error classifying email: {e}")
+            return fallback(*args)
+    
+    if len(args_list) <= 1:
+        return [run(args) for args in args_list]
+    with ThreadPoolExecutor(max_workers=min(CLASSIFY_CONCURRENCY, len(args_list))) as executor:
+        return list(executor.map(run, args_list))
+
+
 def classify_email(
     from_email: str,
     subject: str,
@@ -52,74 +315,195 @@ def classify_email(
     Returns:
         EmailClassification with category and recommended actions
     """
-    # Truncate body if too long
-    max_body_len = 1500
-    truncated_body = body[:max_body_len] + "..." if len(body) > max_body_len else body
+    cache_key = _classification_cache_key(from_email, subject, body)
+    cached = _get_cached_classification(cache_key) or _get_sender_classification(from_email)
+    if cached:
+        print(f"Using cached classification for email from {from_email}")
+        return cached
     
-    system_prompt = """You are an email classification assistant. Analyze emails and classify them accurately.
-You must respond with valid JSON only, no other text."""
-
     prompt = f"""Analyze this email and classify it. Respond with a JSON object.
 
 **From:** {from_email}
 **Subject:** {subject}
 **Body:**
-{truncated_body}
+{_truncate_body(body)}
 
 Respond with this exact JSON structure:
 {{
-    "category": "support_request" | "promotion" | "spam" | "newsletter" | "automated" | "inquiry" | "complaint" | "feedback" | "other",
-    "confidence": 0.0 to 1.0,
-    "priority": 1 to 5 (1=highest, 5=lowest),
-    "should_respond": true/false,
-    "should_delete": true/false,
-    "should_archive": true/false,
-    "reason": "Brief explanation of classification",
-    "suggested_action": "What to do with this email"
+{CLASSIFICATION_FIELDS}
 }}
 
-Classification guidelines:
-- promotion/spam/newsletter: should_delete=true or should_archive=true, should_respond=false
-- support_request/inquiry/complaint: should_respond=true, priority 1-3
-- automated: should_archive=true, should_respond=false
-- complaint: priority=1, should_respond=true
-- feedback: priority=3, should_respond=true (acknowledge)"""
+{CLASSIFICATION_GUIDELINES}"""
 
     result = call_openrouter_structured(
         prompt=prompt,
         model=OPENROUTER_CLASSIFIER_MODEL,
-        system_prompt=system_prompt,
-        max_tokens=512
+        system_prompt=CLASSIFIER_SYSTEM_PROMPT,
+        max_tokens=CLASSIFICATION_MAX_TOKENS,
+        json_schema=CLASSIFICATION_SCHEMA,
+        temperature=0.0
     )
     
     if result:
+        classification = _parse_classification(result)
+        if classification:
+            _cache_classification(cache_key, classification)
+            _remember_sender_classification(from_email, classification)
+            return classification
+    
+    return _default_classification()
+
+
+def classify_emails_batch(items: List[Tuple[str, str, str]]) -> List[EmailClassification]:
+    """
+    Classify several emails with one AI request per batch
+    
+    Args:
+        items: (from_email, subject, body) tuples
+        
+    Returns:
+        One EmailClassification per item, in input order
+    """
+    # Only emails without a cached result go to the model
+    cache_keys = [_classification_cache_key(*item) for item in items]
+    cached = [
+        _get_cached_classification(key) or _get_sender_classification(item[0])
+        for key, item in zip(cache_keys, items)
+    ]
+    if any(cached):
+        uncached_indexes = [i for i, classification in enumerate(cached) if classification is None]
+        print(f"Using cached classifications for {len(items) - len(uncached_indexes)} of {len(items)} email(s)")
+        if uncached_indexes:
+            fresh = classify_emails_batch([items[i] for i in uncached_indexes])
+            for i, classification in zip(uncached_indexes, fresh):
+                cached[i] = classification
+        return cached
+    
+    if len(items) <= BATCH_CLASSIFY_THRESHOLD:
+        return _run_concurrently(classify_email, items, lambda *item: _default_classification())
+    
+    if len(items) > MAX_CLASSIFY_BATCH_SIZE:
+        # Oversized inboxes are split into batches that are sent concurrently
+        chunks = [(items[start:start + MAX_CLASSIFY_BATCH_SIZE],) for start in range(0, len(items), MAX_CLASSIFY_BATCH_SIZE)]
+        results = []
+        for chunk_results in _run_concurrently(
+            classify_emails_batch, chunks, lambda chunk: [_default_classification() for _ in chunk]
+        ):
+            results.extend(chunk_results)
+        return results
+    
+    emails = "\n\n".join(
+        f"""### Email id={i}
+**From:** {from_email}
+**Subject:** {subject}
+**Body:**
+{_truncate_body(body)}"""
+        for i, (from_email, subject, body) in enumerate(items)
+    )
+    
+    prompt = f"""Analyze each of the {len(items)} emails below and classify them. Respond with a JSON object.
+
+{emails}
+
+Respond with this exact JSON structure, one entry per email, echoing each email's id:
+{{
+    "results": [{{
+    "id": 0,
+{CLASSIFICATION_FIELDS}
+    }}, ...]
+}}
+
+{CLASSIFICATION_GUIDELINES}"""
+
+    result = call_openrouter_structured(
+        prompt=prompt,
+        model=OPENROUTER_CLASSIFIER_MODEL,
+        system_prompt=CLASSIFIER_SYSTEM_PROMPT,
+        max_tokens=CLASSIFICATION_MAX_TOKENS * len(items),
+        json_schema=BATCH_CLASSIFICATION_SCHEMA,
+        temperature=0.0
+    )
+    
+    # Match results back to emails by the echoed id, not by position
+    classifications: Dict[int, EmailClassification] = {}
+    entries = result.get("results") if isinstance(result, dict) else None
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
         try:
-            return EmailClassification(
-                category=EmailCategory(result.get("category", "other")),
-                confidence=float(result.get("confidence", 0.5)),
-                priority=int(result.get("priority", 3)),
-                should_respond=bool(result.get("should_respond", True)),
-                should_delete=bool(result.get("should_delete", False)),
-                should_archive=bool(result.get("should_archive", False)),
-                reason=str(result.get("reason", "Classification completed")),
-                suggested_action=str(result.get("suggested_action", "Review manually"))
-            )
-        except (ValueError, KeyError) as e:
-            print(f"Error parsing classification result: {e}")
-    
-    # Default: treat as support request to be safe
+            index = int(entry.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < len(items) and index not in classifications:
+            classification = _parse_classification(entry)
+            if classification:
+                classifications[index] = classification
+                _cache_classification(cache_keys[index], classification)
+                _remember_sender_classification(items[index][0], classification)
+    
+    missing = len(items) - len(classifications)
+    if missing:
+        print(f"Batch classification returned no result for {missing} of {len(items)} email(s), classifying them individually")
+    
+    missing_indexes = [i for i in range(len(items)) if i not in classifications]
+    retried = _run_concurrently(
+        classify_email, [items[i] for i in missing_indexes], lambda *item: _default_classification()
+    )
+    classifications.update(zip(missing_indexes, retried))
+    
+    return [classifications[i] for i in range(len(items))]
+
+
+def _rule_classification(category: EmailCategory, reason: str) -> EmailClassification:
+    """Classification for mail recognized from its headers"""
     return EmailClassification(
-        category=EmailCategory.OTHER,
-        confidence=0.3,
-        priority=3,
-        should_respond=True,
-        should_delete=False,
-        should_archive=False,
-        reason="Classification failed, defaulting to manual review",
-        suggested_action="Forward for manual review"
+        category=category,
+        confidence=0.95,
+        priority=5,
+        should_respond=False,
+        should_delete=category == EmailCategory.SPAM,
+        should_archive=category != EmailCategory.SPAM,
+        reason=reason,
+        suggested_action="Filtered by header rules"
     )
 
 
+def fast_classify(headers: Mapping[str, str], from_email: str, subject: str) -> Optional[EmailClassification]:
+    """
+    Classify obvious bulk, automated and spoofed mail from its headers alone
+    
+    Args:
+        headers: The message headers (an email.message.Message works)
+        from_email: Sender email address
+        subject: Email subject
+        
+    Returns:
+        EmailClassification when a rule matches, None when the email needs the AI classifier
+    """
+    authentication_results = headers.get("Authentication-Results") or ""
+    if DMARC_REJECT_PATTERN.search(str(authentication_results)):
+        return _rule_classification(EmailCategory.SPAM, "Sender failed DMARC with a reject policy")
+    
+    auto_submitted = str(headers.get("Auto-Submitted") or "").strip().lower()
+    if auto_submitted and auto_submitted != "no":
+        return _rule_classification(EmailCategory.AUTOMATED, f"Auto-Submitted: {auto_submitted}")
+    
+    precedence = str(headers.get("Precedence") or "").strip().lower()
+    if precedence == "junk":
+        return _rule_classification(EmailCategory.SPAM, "Precedence: junk")
+    
+    if AUTOMATED_SENDER_PATTERN.search(from_email or ""):
+        return _rule_classification(EmailCategory.AUTOMATED, "Sent from a no-reply or system address")
+    
+    if headers.get("List-Unsubscribe") or headers.get("List-Id") or precedence in BULK_PRECEDENCE:
+        return _rule_classification(EmailCategory.NEWSLETTER, "Mailing list or bulk mail headers")
+    
+    if NEWSLETTER_SENDER_PATTERN.search(from_email or ""):
+        return _rule_classification(EmailCategory.NEWSLETTER, "Sent from a newsletter address")
+    
+    return None
+
+
 def is_spam_or_promotion(classification: EmailClassification) -> bool:
     """Check if email should be filtered out"""
     spam_categories = {
@@ -138,16 +522,20 @@ def needs_response(classification: EmailClassification) -> bool:
     return classification.should_respond
 
 
+# Emoji per priority level, indexed by priority (0 is unused)
+PRIORITY_EMOJIS = (
+    "⚪",
+    "🔴",  # Critical
+    "🟠",  # High
+    "🟡",  # Medium
+    "🟢",  # Low
+    "⚪",  # Very Low
+)
+
+
 def get_priority_emoji(priority: int) -> str:
     """Get emoji for priority level"""
-    emojis = {
-        1: "🔴",  # Critical
-        2: "🟠",  # High
-        3: "🟡",  # Medium
-        4: "🟢",  # Low
-        5: "⚪",  # Very Low
-    }
-    return emojis.get(priority, "⚪")
+    return PRIORITY_EMOJIS[priority] if 1 <= priority <= 5 else "⚪"
 
 
 def format_classification_summary(classification: EmailClassification) -> str:
@@ -2,36 +2,208 @@ import smtplib
 import imaplib
 import email
 import os
+import json
+import html
+import logging
+import select
 import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from email import encoders
 from email.header import decode_header
+from email.parser import BytesHeaderParser
+from email.utils import collapse_rfc2231_value
 import re
-from typing import Optional, Tuple, List, Dict
+from typing import Iterator, Optional, Tuple, List, Dict
 from ..config.settings import (
     EMAIL_SMTP_SERVER, EMAIL_SMTP_PORT, EMAIL_USERNAME, EMAIL_PASSWORD,
-    EMAIL_IMAP_SERVER, EMAIL_IMAP_PORT, EMAIL_CHECK_INTERVAL
+    EMAIL_IMAP_SERVER, EMAIL_IMAP_PORT, EMAIL_CHECK_INTERVAL, EMAIL_SEEN_IDS_FILE,
+    CLASSIFY_CONCURRENCY, EMAIL_CALLBACK_WORKERS
 )
 import time
 
+logger = logging.getLogger(__name__)
+
+# Recently processed Message-IDs, oldest first, used to skip duplicate deliveries
+MAX_SEEN_MESSAGE_IDS = 10000
+_seen_message_ids: "OrderedDict[str, None]" = OrderedDict()
+_seen_lock = threading.Lock()
+
+# Batches classified in the background while the next messages are fetched and parsed
+MAX_CLASSIFY_BATCHES_IN_FLIGHT = CLASSIFY_CONCURRENCY
+_classify_executor = ThreadPoolExecutor(max_workers=MAX_CLASSIFY_BATCHES_IN_FLIGHT, thread_name_prefix="classify")
+
+# Callbacks (ticket, acknowledgment, AI draft) run on worker threads so a slow LLM call doesn't
+# hold up the rest of the inbox; the polling thread waits once this many are queued
+MAX_CALLBACKS_QUEUED = EMAIL_CALLBACK_WORKERS * 2
+_callback_executor = ThreadPoolExecutor(max_workers=EMAIL_CALLBACK_WORKERS, thread_name_prefix="email-callback")
+
+# Messages requested per IMAP FETCH command, bounding memory held for one round-trip
+IMAP_FETCH_BATCH_SIZE = 50
+FETCH_NUMBER_RE = re.compile(rb'(\d+) ')
+# Parses the header block only; nothing after the blank line is treated as MIME structure
+HEADER_PARSER = BytesHeaderParser()
+
+# Comments and <script>/<style>/<head> blocks hold no readable text (marketing mail is full of CSS)
+HTML_HIDDEN_RE = re.compile(r'<!--.*?-->|<(script|style|head)\b[^>]*>.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+HTML_START_MARKERS = ('<html', '<!doctype', '<head', '<body', '<div', '<p', '<table')
+WHITESPACE_RE = re.compile(r'\s+')
+EMAIL_ADDRESS_RE = re.compile(r'[\w\.-]+@[\w\.-]+')
+
+def is_duplicate_message(message_id: Optional[str], record: bool = True) -> bool:
+    """Check whether a Message-ID was already processed, recording it if not (unless record=False)"""
+    if not message_id:
+        return False
+    
+    message_id = message_id.strip()
+    with _seen_lock:
+        if message_id in _seen_message_ids:
+            return True
+        if not record:
+            return False
+        _seen_message_ids[message_id] = None
+        if len(_seen_message_ids) > MAX_SEEN_MESSAGE_IDS:
+            _seen_message_ids.popitem(last=False)
+    return False
+
+def run_and_record(callback, message_id: Optional[str], *args, **kwargs) -> None:
+    """Run an email callback, recording its Message-ID only once it has succeeded"""
+    callback(*args, **kwargs)
+    is_duplicate_message(message_id)
+
+def load_seen_message_ids() -> int:
+    """Load processed Message-IDs saved by a previous run"""
+    try:
+        with open(EMAIL_SEEN_IDS_FILE, 'r', encoding='utf-8') as f:
+            message_ids = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        print(f"Error loading seen Message-IDs: {e}")
+        return 0
+    
+    with _seen_lock:
+        for message_id in message_ids[-MAX_SEEN_MESSAGE_IDS:]:
+            _seen_message_ids[message_id] = None
+        return len(_seen_message_ids)
+
+def save_seen_message_ids() -> bool:
+    """Persist processed Message-IDs so a restart doesn't reprocess them"""
+    try:
+        with _seen_lock:
+            message_ids = list(_seen_message_ids)
+        with open(EMAIL_SEEN_IDS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(message_ids, f)
+        return True
+    except Exception as e:
+        print(f"Error saving seen Message-IDs: {e}")
+        return False
+
+# Mail server connections kept open between polls and sends, so each one doesn't pay for a
+# new TCP/TLS handshake and login
+_imap_connection: Optional[imaplib.IMAP4_SSL] = None
+_imap_lock = threading.Lock()
+_smtp_connection: Optional[smtplib.SMTP] = None
+_smtp_lock = threading.Lock()
+
+def _close_imap_connection() -> None:
+    """Log out of the shared IMAP connection, ignoring errors from a dead socket (caller holds _imap_lock)"""
+    global _imap_connection
+    if _imap_connection is not None:
+        try:
+            _imap_connection.logout()
+        except Exception:
+            pass
+        _imap_connection = None
+
+def _close_smtp_connection() -> None:
+    """Quit the shared SMTP connection, ignoring errors from a dead socket (caller holds _smtp_lock)"""
+    global _smtp_connection
+    if _smtp_connection is not None:
+        try:
+            _smtp_connection.quit()
+        except Exception:
+            pass
+        _smtp_connection = None
+
+@contextmanager
+def imap_session() -> Iterator[imaplib.IMAP4_SSL]:
+    """
+    Yield the shared IMAP connection, logged in with INBOX selected.
+    An idle connection is checked with NOOP and replaced if the server has dropped it;
+    an error inside the block discards the connection so the next session starts fresh.
+    """
+    global _imap_connection
+    with _imap_lock:
+        if _imap_connection is not None:
+            try:
+                alive = _imap_connection.noop()[0] == 'OK'
+            except Exception:
+                alive = False
+            if not alive:
+                print("IMAP connection lost, reconnecting...")
+                _close_imap_connection()
+        
+        if _imap_connection is None:
+            print(f"Connecting to IMAP server: {EMAIL_IMAP_SERVER}:{EMAIL_IMAP_PORT}")
+            imap = imaplib.IMAP4_SSL(EMAIL_IMAP_SERVER, EMAIL_IMAP_PORT)
+            print("IMAP connection established")
+            try:
+                imap.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+                print(f"Logged in as {EMAIL_USERNAME}")
+                imap.select('INBOX')
+                print("Selected INBOX folder")
+            except Exception:
+                imap.shutdown()
+                raise
+            _imap_connection = imap
+        
+        try:
+            yield _imap_connection
+        except Exception:
+            _close_imap_connection()
+            raise
+
+def _get_smtp_connection() -> smtplib.SMTP:
+    """Return the shared SMTP connection, connecting and logging in if needed (caller holds _smtp_lock)"""
+    global _smtp_connection
+    if _smtp_connection is None:
+        server = smtplib.SMTP(EMAIL_SMTP_SERVER, EMAIL_SMTP_PORT, timeout=60)
+        try:
+            server.starttls()
+            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+        except Exception:
+            server.close()
+            raise
+        _smtp_connection = server
+    return _smtp_connection
+
+def shutdown_email_workers() -> None:
+    """Wait for classification and callbacks still in flight, then stop their worker threads"""
+    _classify_executor.shutdown(wait=True)
+    _callback_executor.shutdown(wait=True)
+
+def close_mail_connections() -> None:
+    """Close the shared IMAP and SMTP connections"""
+    with _imap_lock:
+        _close_imap_connection()
+    with _smtp_lock:
+        _close_smtp_connection()
+
 def html_to_text(html_content: str) -> str:
     """Convert HTML to plain text by removing tags"""
-    # Remove HTML tags
-    text = re.sub(r'<[^>]+>', ' ', html_content)
-    # Fix spacing
-    text = re.sub(r'\s+', ' ', text)
-    # Handle special HTML entities
-    text = text.replace('&nbsp;', ' ')
-    text = text.replace('&amp;', '&')
-    text = text.replace('&lt;', '<')
-    text = text.replace('&gt;', '>')
-    text = text.replace('&quot;', '"')
-    text = text.replace('&#39;', "'")
-    # Trim whitespace
-    return text.strip()
+    # Drop non-text blocks and HTML tags, decode all entities in one pass, then fix spacing
+    # (this also turns &nbsp; into a space)
+    text = HTML_HIDDEN_RE.sub(' ', html_content)
+    text = html.unescape(HTML_TAG_RE.sub(' ', text))
+    return WHITESPACE_RE.sub(' ', text).strip()
 
 def send_email(to_email: str, subject: str, html_content: str, attachments: List[Dict] = None) -> bool:
     """Send an email using SMTP with optional attachments"""
@@ -60,12 +232,19 @@ def send_email(to_email: str, subject: str, html_content: str, attachments: List
             msg.attach(part)
     
     try:
-        with smtplib.SMTP(EMAIL_SMTP_SERVER, EMAIL_SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-            server.send_message(msg)
-            print(f"Email sent to {to_email}: {subject}")
-            return True
+        with _smtp_lock:
+            try:
+                try:
+                    _get_smtp_connection().send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # The server closed the idle connection; reconnect once and resend
+                    _close_smtp_connection()
+                    _get_smtp_connection().send_message(msg)
+            except Exception:
+                _close_smtp_connection()
+                raise
+        print(f"Email sent to {to_email}: {subject}")
+        return True
     except Exception as e:
         print(f"Failed to send email: {e}")
         return False
@@ -117,96 +296,158 @@ def decode_email_header(header_value: str) -> str:
         print(f"Error decoding header '{header_value}': {e}")
         return header_value  # Return original if decoding fails
 
-def extract_email_details(email_message: email.message.Message) -> Tuple[str, str, str, List[Dict]]:
-    """Extract email details and attachments from an email message"""
+def extract_sender_and_subject(email_message: email.message.Message) -> Tuple[str, str]:
+    """Decode the sender address and subject from a message's headers"""
     # Extract subject with better decoding
     raw_subject = email_message.get("subject", "")
     subject = decode_email_header(raw_subject)
-    print(f"Raw subject: {raw_subject}")
-    print(f"Decoded subject: {subject}")
+    logger.debug("Raw subject: %s", raw_subject)
+    logger.debug("Decoded subject: %s", subject)
     
     # Extract from email with better decoding
     raw_from = email_message.get("from", "")
     from_email_full = decode_email_header(raw_from)
-    print(f"Raw from: {raw_from}")
-    print(f"Decoded from: {from_email_full}")
+    logger.debug("Raw from: %s", raw_from)
+    logger.debug("Decoded from: %s", from_email_full)
     
     # Extract email address from the "from_email" field which might include name
-    email_pattern = r'[\w\.-]+@[\w\.-]+'
-    match = re.search(email_pattern, from_email_full)
+    match = EMAIL_ADDRESS_RE.search(from_email_full)
     if match:
         from_email = match.group(0)
     else:
         from_email = from_email_full  # Fallback
     
+    return from_email, subject
+
+def decode_part_text(part: email.message.Message) -> str:
+    """Decode a text part's payload using its declared charset (UTF-8 if none or unknown)"""
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+def looks_like_html(text: str) -> bool:
+    """Cheap check for HTML sent with a text/plain content type (only looks at the start of the text)"""
+    return text[:4096].lstrip().lower().startswith(HTML_START_MARKERS)
+
+# Content types treated as attachments even without a filename or Content-Disposition
+ATTACHMENT_CONTENT_TYPES = (
+    'application/octet-stream',
+    'application/pdf',
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument',
+    'application/vnd.ms-excel',
+    'application/zip',
+    'application/x-zip',
+    'application/x-zip-compressed',
+    'image/png',
+    'image/jpeg',
+    'image/jpg',
+    'image/gif',
+)
+
+# Small inline images referenced by Content-ID (signature logos, social icons) are not kept
+EMBEDDED_IMAGE_MAX_ENCODED_BYTES = 16 * 1024
+# Attachments beyond this total (estimated from the encoded size) are skipped without decoding
+MAX_ATTACHMENT_BYTES = 25 * 1024 * 1024
+
+def is_embedded_image(part: email.message.Message, content_type: str, encoded_size: int) -> bool:
+    """True for a small inline image embedded in the HTML body rather than sent as a file"""
+    return (
+        content_type.startswith('image/')
+        and part.get('Content-ID') is not None
+        and part.get_content_disposition() != 'attachment'
+        and encoded_size <= EMBEDDED_IMAGE_MAX_ENCODED_BYTES
+    )
+
+def save_attachment_payload(filename: str, payload: bytes) -> str:
+    """Write an attachment to a uniquely named temp file and return its path"""
+    # The filename comes from the sender, so never let it pick the directory
+    safe_name = os.path.basename(filename.replace('\\', '/')) or "attachment"
+    with tempfile.NamedTemporaryFile(prefix='att_', suffix='_' + safe_name, delete=False) as temp_file:
+        temp_file.write(payload)
+        return temp_file.name
+
+def detect_attachment_filename(part: email.message.Message, content_type: str) -> Tuple[Optional[str], bool]:
+    """Return (filename, is_attachment) for a non-multipart MIME part"""
+    content_disposition = part.get('Content-Disposition', '')
+    
+    # A filename in either header marks an attachment
+    filename = part.get_filename()
+    if not filename:
+        name = part.get_param('name')
+        if name:
+            # RFC 2231 encoded names come back as (charset, language, value)
+            filename = collapse_rfc2231_value(name)
+    if filename:
+        return filename, True
+    
+    if "attachment" in content_disposition or "inline" in content_disposition:
+        return None, True
+    
+    # Unnamed binary parts of a common attachment type (text parts are bodies)
+    if part.get_content_maintype() != 'text' and content_type.startswith(ATTACHMENT_CONTENT_TYPES):
+        return None, True
+    return None, False
+
+def extract_email_details(email_message: email.message.Message) -> Tuple[str, str, str, List[Dict], bool]:
+    """Extract email details and attachments from an email message (the last value tells whether the body is HTML)"""
+    from_email, subject = extract_sender_and_subject(email_message)
+    
     # Get email body and attachments
     body = ""
+    is_html = False
     attachments = []
+    attachment_bytes = 0
     
-    print(f"Processing email: '{subject}' from '{from_email}'")
-    print(f"Email is multipart: {email_message.is_multipart()}")
+    logger.debug("Processing email: '%s' from '%s'", subject, from_email)
+    logger.debug("Email is multipart: %s", email_message.is_multipart())
     
-    # Print all email headers for debugging
-    print("===== EMAIL HEADERS =====")
-    for header, value in email_message.items():
-        print(f"{header}: {value}")
-    print("=========================")
+    # Dump all email headers only when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("===== EMAIL HEADERS =====")
+        for header, value in email_message.items():
+            logger.debug("%s: %s", header, value)
+        logger.debug("=========================")
     
     if email_message.is_multipart():
         for part_index, part in enumerate(email_message.walk()):
             content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-            
-            print(f"Part {part_index}: type={content_type}, disposition={content_disposition}")
-            
-            # Debug headers for each part
-            print(f"Part {part_index} headers:")
-            for header, value in part.items():
-                print(f"  {header}: {value}")
-            
-            # Enhanced attachment detection logic
-            is_attachment = False
-            
-            # Check standard Content-Disposition header
-            if "attachment" in content_disposition or "inline" in content_disposition:
-                is_attachment = True
-                print(f"Part {part_index} identified as attachment via Content-Disposition: {content_disposition}")
-            
-            # Check filename parameters 
-            filename = part.get_filename()
-            if filename:
-                is_attachment = True
-                print(f"Part {part_index} has filename: {filename}")
+            if part.get_content_maintype() == 'multipart':
+                continue
             
-            # Check Content-Type name parameter
-            content_type_params = part.get_params() or []
-            for param in content_type_params:
-                if param[0].lower() == 'name':
-                    filename = param[1]
-                    is_attachment = True
-                    print(f"Part {part_index} has Content-Type name param: {filename}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Part %s: type=%s, disposition=%s", part_index, content_type, part.get('Content-Disposition'))
+                for header, value in part.items():
+                    logger.debug("  %s: %s", header, value)
             
+            filename, is_attachment = detect_attachment_filename(part, content_type)
             if is_attachment:
                 if not filename:
-                    filename = f"attachment_{len(attachments)}"
+                    ext = content_type.split('/')[-1].replace('jpeg', 'jpg')
+                    filename = f"attachment_{len(attachments) + 1}.{ext}"
                 
-                print(f"Processing attachment: {filename}")
+                # Decide from the still-encoded payload whether this part is worth decoding
+                raw_payload = part.get_payload()
+                encoded_size = len(raw_payload) if isinstance(raw_payload, str) else 0
+                if is_embedded_image(part, content_type, encoded_size):
+                    logger.debug("Skipping embedded image: %s", filename)
+                    continue
+                if attachment_bytes + encoded_size * 3 // 4 > MAX_ATTACHMENT_BYTES:
+                    print(f"Warning: Skipping attachment '{filename}', attachments exceed {MAX_ATTACHMENT_BYTES} bytes")
+                    continue
                 
                 # Get the attachment data
                 payload = part.get_payload(decode=True)
                 if payload:
                     payload_size = len(payload)
-                    print(f"Found attachment: '{filename}', type: {content_type}, size: {payload_size} bytes")
-                
-                    # Create temporary file to store attachment
-                    temp_dir = tempfile.gettempdir()
-                    file_path = os.path.join(temp_dir, filename)
-                    
-                    # Save attachment to temporary file
-                    with open(file_path, 'wb') as f:
-                        f.write(payload)
+                    attachment_bytes += payload_size
+                    logger.debug("Found attachment: '%s', type: %s, size: %s bytes", filename, content_type, payload_size)
                     
-                    print(f"Saved attachment to: {file_path}")
+                    file_path = save_attachment_payload(filename, payload)
+                    del payload
+                    logger.debug("Saved attachment to: %s", file_path)
                     
                     attachments.append({
                         'filename': filename,
@@ -217,38 +458,120 @@ def extract_email_details(email_message: email.message.Message) -> Tuple[str, st
                 else:
                     print(f"Warning: Attachment '{filename}' has no payload")
                 continue
-                
-            if content_type == "text/html":
-                body = part.get_payload(decode=True).decode()
-                print(f"Found HTML body: {len(body)} characters")
-                break
+            
+            # Keep walking after the body so attachments further down are still found
+            if content_type == "text/html" and not is_html:
+                body = decode_part_text(part)
+                is_html = True
+                logger.debug("Found HTML body: %s characters", len(body))
             elif content_type == "text/plain" and not body:
-                body = part.get_payload(decode=True).decode()
-                print(f"Found plain text body: {len(body)} characters")
+                body = decode_part_text(part)
+                logger.debug("Found plain text body: %s characters", len(body))
     else:
-        body = email_message.get_payload(decode=True).decode()
-        print(f"Non-multipart email, body length: {len(body)} characters")
+        body = decode_part_text(email_message)
+        is_html = email_message.get_content_type() == "text/html"
+        logger.debug("Non-multipart email, body length: %s characters", len(body))
     
-    print(f"Extracted {len(attachments)} attachments from email")
-    return from_email, subject, body, attachments
+    if not is_html:
+        is_html = looks_like_html(body)
+    
+    logger.debug("Extracted %s attachments from email", len(attachments))
+    return from_email, subject, body, attachments, is_html
+
+# IDLE is driven outside imaplib's command machinery; imaplib's own tags are uppercase, so this can't clash
+IDLE_TAG = b'idle'
+# Seconds to wait for the server to answer IDLE or DONE
+EMAIL_IDLE_REPLY_TIMEOUT = 30
+
+def read_imap_line(sock, buffer: bytearray, wait: float) -> Optional[bytes]:
+    """
+    Read one line straight from the socket into buffer (bypassing imaplib's buffered file, which
+    select() can't see into), or return None if no full line arrives within wait seconds
+    """
+    while b'\n' not in buffer:
+        # Data already decrypted by the SSL layer doesn't make the socket readable again
+        if not (hasattr(sock, 'pending') and sock.pending()):
+            readable, _, _ = select.select([sock], [], [], wait)
+            if not readable:
+                return None
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        buffer += chunk
+    end = buffer.index(b'\n') + 1
+    line = bytes(buffer[:end])
+    del buffer[:end]
+    return line
+
+def wait_for_new_mail(timeout: int, is_running) -> bool:
+    """
+    Wait in IMAP IDLE on the shared connection until the server reports new mail (EXISTS),
+    the timeout passes, or is_running() turns false.
+    Returns False without waiting if the server doesn't support IDLE.
+    """
+    with imap_session() as imap:
+        if 'IDLE' not in imap.capabilities:
+            return False
+        
+        # The previous command was read up to its completion, so nothing is left in imaplib's
+        # buffer; everything until IDLE ends is read from the socket here
+        sock = imap.socket()
+        buffer = bytearray()
+        imap.send(IDLE_TAG + b' IDLE\r\n')
+        line = read_imap_line(sock, buffer, EMAIL_IDLE_REPLY_TIMEOUT)
+        if not line or not line.startswith(b'+'):
+            raise imap.error("server did not accept IDLE")
+        
+        deadline = time.monotonic() + timeout
+        while is_running() and time.monotonic() < deadline:
+            # Wake up once a second so a shutdown isn't held up by the IDLE
+            line = read_imap_line(sock, buffer, 1)
+            if line and line.startswith(b'*') and line.rstrip().endswith(b'EXISTS'):
+                print("Server reported new email")
+                break
+        
+        # Leave IDLE and read up to the command's completion
+        imap.send(b'DONE\r\n')
+        while True:
+            line = read_imap_line(sock, buffer, EMAIL_IDLE_REPLY_TIMEOUT)
+            if line is None:
+                raise imap.abort("no reply while leaving IDLE")
+            if line.startswith(IDLE_TAG + b' '):
+                break
+        return True
+
+def iter_fetched_messages(fetch_data: List) -> Iterator[Tuple[bytes, bytes]]:
+    """Yield (message number, raw message) pairs from a multi-message FETCH response"""
+    for item in fetch_data:
+        # Message data arrives as (b'<num> (BODY[] {<size>}', <bytes>) tuples separated by b')'
+        if not isinstance(item, tuple):
+            continue
+        match = FETCH_NUMBER_RE.match(item[0])
+        if match:
+            yield match.group(1), item[1]
 
-def check_new_emails(callback) -> None:
-    """Check for new emails in a continuous loop and call the callback function for each new email"""
+def check_new_emails(callback, classify_batch=None, batch_size: int = 20, prefilter=None, discard=None) -> None:
+    """
+    Check for new emails in a continuous loop and call the callback function for each new email.
+    Callbacks run on up to EMAIL_CALLBACK_WORKERS worker threads, so the callback must be thread-safe;
+    every callback of a sweep has finished before the next check.
+    When classify_batch is given, emails are collected in groups of batch_size, classified with one
+    classify_batch([(from_email, subject, plain_body), ...]) call per group, and each result is
+    passed to the callback as classification=...
+    When prefilter is given, prefilter(headers, from_email, subject) runs on the headers first; a
+    non-None result is passed straight to the callback as the classification. If discard(classification)
+    is also true the email will be dropped, so its body is never downloaded and the callback gets
+    empty body, plain_body and attachments.
+    """
     # Use the global running variable from main module
     import src.main
     
     while src.main.running:
         try:
             print("Checking for new emails...")
-            print(f"Connecting to IMAP server: {EMAIL_IMAP_SERVER}:{EMAIL_IMAP_PORT}")
+            callbacks = deque()  # (num, future) for emails being handled, oldest first
             
-            with imaplib.IMAP4_SSL(EMAIL_IMAP_SERVER, EMAIL_IMAP_PORT) as imap:
-                print("IMAP connection established")
-                imap.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-                print(f"Logged in as {EMAIL_USERNAME}")
-                imap.select('INBOX')
-                print("Selected INBOX folder")
-                
+            with imap_session() as imap:
                 # Check if we're still running
                 if not src.main.running:
                     break
@@ -264,50 +587,186 @@ def check_new_emails(callback) -> None:
                 else:
                     print("No new emails")
                 
-                for num in message_numbers[0].split():
-                    # Check if we're still running
-                    if not src.main.running:
-                        break
-                        
-                    print(f"Processing email #{num}...")
-                    status, msg_data = imap.fetch(num, '(RFC822)')
-                    if status != 'OK':
-                        print(f"Error fetching email #{num}: {status}")
-                        continue
-                    
-                    print(f"Successfully fetched email #{num}")
-                    email_body = msg_data[0][1]
-                    email_message = email.message_from_bytes(email_body)
-                    
+                # Messages are fetched with BODY.PEEK[] (which leaves them unread) and flagged \Seen only
+                # once handled, so an interrupted sweep picks the rest up next time
+                handled = []
+                pending = []
+                in_flight = deque()  # (future, emails) for batches being classified, oldest first
+                sweep_ids = set()  # Message-IDs handed to a callback this sweep (recorded once it succeeds)
+                
+                def is_duplicate(message_id):
+                    """Already processed, or already being handled in this sweep"""
+                    if is_duplicate_message(message_id, record=False):
+                        return True
+                    if message_id:
+                        if message_id.strip() in sweep_ids:
+                            return True
+                        sweep_ids.add(message_id.strip())
+                    return False
+                
+                def run_callback(num, message_id, *args, **kwargs):
+                    """Hand an email to the callback on a worker thread"""
+                    print(f"Calling callback for email #{num} with {len(args[4])} attachment(s)")
+                    future = _callback_executor.submit(run_and_record, callback, message_id, *args, **kwargs)
+                    callbacks.append((num, future))
+                    while len(callbacks) > MAX_CALLBACKS_QUEUED:
+                        finish_callback(*callbacks.popleft())
+                
+                def finish_callback(num, future):
+                    """Wait for a callback; its message is flagged \\Seen (and its Message-ID kept) only if it succeeded"""
+                    try:
+                        future.result()
+                        handled.append(num)
+                    except Exception as e:
+                        print(f"Error handling email #{num}: {e}")
+                
+                def collect_callbacks(wait: bool):
+                    """Collect finished callbacks in order (all of them when wait=True)"""
+                    while callbacks and (wait or callbacks[0][1].done()):
+                        finish_callback(*callbacks.popleft())
+                
+                def mark_handled_seen():
+                    """Flag every handled message as read with a single STORE"""
+                    collect_callbacks(wait=False)
+                    if handled:
+                        imap.store(b','.join(handled), '+FLAGS', '\\Seen')
+                        handled.clear()
+                
+                def dispatch_pending():
+                    """Start classifying the collected emails in the background while fetching continues"""
+                    if not pending:
+                        return
+                    emails = list(pending)
+                    pending.clear()
+                    future = _classify_executor.submit(classify_batch, [(item[0], item[1], item[3]) for _, _, item in emails])
+                    in_flight.append((future, emails))
+                    # Don't run too far ahead of the callbacks
+                    while len(in_flight) > MAX_CLASSIFY_BATCHES_IN_FLIGHT:
+                        handle_classified(in_flight.popleft())
+                
+                def handle_classified(batch):
+                    """Wait for a batch's classifications, then hand each email to the callback in order"""
+                    future, emails = batch
+                    try:
+                        classifications = future.result()
+                    except Exception as e:
+                        # The callback classifies each email itself when given no classification
+                        print(f"Error classifying emails: {e}")
+                        classifications = [None] * len(emails)
+                    for (num, message_id, item), classification in zip(emails, classifications):
+                        run_callback(num, message_id, *item, classification=classification)
+                
+                def drain_classified(wait: bool):
+                    """Handle finished batches in order (all of them when wait=True)"""
+                    while in_flight and (wait or in_flight[0][0].done()):
+                        handle_classified(in_flight.popleft())
+                
+                def process_message(num, message_id, email_message, classification):
+                    """Extract a fetched email and hand it to the callback (or the classification batch)"""
                     # Extract email details
-                    print(f"Extracting details from email #{num}...")
-                    from_email, subject, body, attachments = extract_email_details(email_message)
-                    
-                    # If no attachments were found using regular method, try alternative method
-                    if not attachments and email_message.is_multipart():
-                        print("No attachments found with standard extraction, trying fallback method...")
-                        fallback_attachments = extract_attachments_fallback(email_message)
-                        if fallback_attachments:
-                            print(f"Fallback method found {len(fallback_attachments)} attachment(s)")
-                            attachments = fallback_attachments
+                    logger.debug("Extracting details from email #%s...", num)
+                    from_email, subject, body, attachments, is_html = extract_email_details(email_message)
                     
                     # Convert HTML body to plain text if needed
                     plain_body = body
-                    if '<html' in body.lower() or '<div' in body.lower() or '<p' in body.lower():
+                    if is_html:
                         plain_body = html_to_text(body)
-                        print(f"Converted HTML to plain text: {len(plain_body)} characters")
+                        logger.debug("Converted HTML to plain text: %s characters", len(plain_body))
+                    
+                    if classification is not None:
+                        run_callback(num, message_id, from_email, subject, body, plain_body, attachments, classification=classification)
+                        return
+                    
+                    if classify_batch:
+                        pending.append((num, message_id, (from_email, subject, body, plain_body, attachments)))
+                        if len(pending) >= batch_size:
+                            dispatch_pending()
+                        return
                     
                     # Call the callback function with the email details
-                    print(f"Calling callback for email #{num} with {len(attachments)} attachment(s)")
-                    callback(from_email, subject, body, plain_body, attachments)
+                    run_callback(num, message_id, from_email, subject, body, plain_body, attachments)
                 
-            # Wait before checking again (using EMAIL_CHECK_INTERVAL env var)
+                message_set = message_numbers[0].split()
+                for start in range(0, len(message_set), IMAP_FETCH_BATCH_SIZE):
+                    if not src.main.running:
+                        break
+                    
+                    # Headers first (one round-trip per group): duplicates and mail filtered by its
+                    # headers never have their bodies and attachments downloaded
+                    fetch_nums = message_set[start:start + IMAP_FETCH_BATCH_SIZE]
+                    status, header_data = imap.fetch(b','.join(fetch_nums), '(BODY.PEEK[HEADER])')
+                    if status != 'OK':
+                        print(f"Error fetching emails {fetch_nums[0]}..{fetch_nums[-1]}: {status}")
+                        continue
+                    
+                    header_classifications = {}
+                    body_nums = []
+                    for num, header_bytes in iter_fetched_messages(header_data):
+                        if not src.main.running:
+                            break
+                        
+                        headers = HEADER_PARSER.parsebytes(header_bytes)
+                        message_id = headers.get("Message-ID")
+                        if is_duplicate_message(message_id, record=False):
+                            print(f"Skipping duplicate email #{num}: {message_id}")
+                            handled.append(num)
+                            continue
+                        
+                        if prefilter:
+                            from_email, subject = extract_sender_and_subject(headers)
+                            classification = prefilter(headers, from_email, subject)
+                            if classification is not None:
+                                print(f"Email #{num} classified from headers: {classification.reason}")
+                                if discard and discard(classification):
+                                    if is_duplicate(message_id):
+                                        handled.append(num)
+                                    else:
+                                        run_callback(num, message_id, from_email, subject, "", "", [], classification=classification)
+                                    continue
+                            header_classifications[num] = classification
+                        body_nums.append(num)
+                    
+                    if body_nums and src.main.running:
+                        status, fetch_data = imap.fetch(b','.join(body_nums), '(BODY.PEEK[])')
+                        if status != 'OK':
+                            print(f"Error fetching emails {body_nums[0]}..{body_nums[-1]}: {status}")
+                            fetch_data = []
+                        
+                        for num, email_body in iter_fetched_messages(fetch_data):
+                            # Check if we're still running
+                            if not src.main.running:
+                                break
+                            
+                            logger.debug("Processing email #%s...", num)
+                            email_message = email.message_from_bytes(email_body)
+                            
+                            # Skip emails we've already turned into tickets
+                            message_id = email_message.get("Message-ID")
+                            if is_duplicate(message_id):
+                                print(f"Skipping duplicate email #{num}: {message_id}")
+                                handled.append(num)
+                                continue
+                            
+                            process_message(num, message_id, email_message, header_classifications.get(num))
+                    
+                    drain_classified(wait=False)
+                    mark_handled_seen()
+                
+                # Handle everything already fetched, even when stopping
+                dispatch_pending()
+                drain_classified(wait=True)
+                collect_callbacks(wait=True)
+                mark_handled_seen()
+                
+            # Wait for the server to announce new mail (IDLE), checking again after at most
+            # EMAIL_CHECK_INTERVAL seconds; plain polling if the server has no IDLE support
             interval = EMAIL_CHECK_INTERVAL
-            print(f"Waiting {interval} seconds before checking again...")
-            for _ in range(interval):
-                if not src.main.running:
-                    break
-                time.sleep(1)
+            print(f"Waiting up to {interval} seconds for new emails...")
+            if not wait_for_new_mail(interval, lambda: src.main.running):
+                for _ in range(interval):
+                    if not src.main.running:
+                        break
+                    time.sleep(1)
                 
         except Exception as e:
             print(f"Error checking emails: {str(e)}")
@@ -315,6 +774,9 @@ def check_new_emails(callback) -> None:
             import traceback
             traceback.print_exc()
             
+            # Let callbacks already started finish before the same messages can be fetched again
+            futures_wait([future for _, future in callbacks])
+            
             # Wait a bit longer if there was an error
             print("Waiting 60 seconds after error...")
             for _ in range(60):
@@ -322,148 +784,21 @@ def check_new_emails(callback) -> None:
                     break
                 time.sleep(1)
 
-def send_response_email(to_email: str, ticket_id: str, response_text: str, attachments: List[Dict] = None) -> bool:
-    """Send a response email to a customer with optional attachments"""
-    html_content = f"""
+# Wrapper for plain-text responses (the text is HTML-escaped and keeps its line breaks)
+RESPONSE_HTML_TEMPLATE = """
     <h2>Response to your support request</h2>
     <p>This is a response to your support ticket (#{ticket_id}).</p>
     <div style="white-space: pre-wrap;">{response_text}</div>
     """
+
+def send_response_email(to_email: str, ticket_id: str, response_text: str, attachments: List[Dict] = None) -> bool:
+    """Send a response email to a customer with optional attachments"""
+    html_content = RESPONSE_HTML_TEMPLATE.format(
+        ticket_id=html.escape(ticket_id),
+        response_text=html.escape(response_text)
+    )
     
     if attachments and len(attachments) > 0:
         html_content += f"<p>We've included {len(attachments)} attachment(s) with this response.</p>"
     
     return send_email(to_email, f"Re: Support Ticket #{ticket_id}", html_content, attachments)
-
-def extract_attachments_fallback(email_message: email.message.Message) -> List[Dict]:
-    """Alternative method to extract attachments from email for cases where standard method fails"""
-    attachments = []
-    
-    print("Using fallback attachment extraction method")
-    
-    # Attachment names sometimes seen in emails
-    attachment_types = [
-        'application/octet-stream',
-        'application/pdf',
-        'application/msword',
-        'application/vnd.openxmlformats-officedocument',
-        'application/vnd.ms-excel',
-        'application/zip',
-        'application/x-zip',
-        'application/x-zip-compressed',
-        'image/png',
-        'image/jpeg',
-        'image/jpg',
-        'image/gif',
-        'text/plain',
-        'text/csv',
-        'text/markdown'
-    ]
-    
-    # Process all parts
-    for part in email_message.walk():
-        # Skip multipart/* - these are just containers
-        if part.get_content_maintype() == 'multipart':
-            print(f"Skipping multipart container: {part.get_content_type()}")
-            continue
-        
-        # Skip if it looks like the main message body
-        if part.get_content_maintype() == 'text' and part.get_content_disposition() is None:
-            if 'attachment' not in str(part.get('Content-Type', '')).lower():
-                print(f"Skipping text body: {part.get_content_type()}")
-                continue
-        
-        # Get different possible filenames
-        filename = None
-        
-        # Try Content-Disposition first
-        content_disp = part.get('Content-Disposition', '')
-        if content_disp:
-            print(f"Content-Disposition: {content_disp}")
-            
-            disp_params = {}
-            for item in content_disp.split(';'):
-                item = item.strip()
-                if '=' in item:
-                    name, value = item.split('=', 1)
-                    # Strip quotes
-                    if value.startswith('"') and value.endswith('"'):
-                        value = value[1:-1]
-                    disp_params[name.lower()] = value
-            
-            if 'filename' in disp_params:
-                filename = disp_params['filename']
-                print(f"Found filename in Content-Disposition params: {filename}")
-        
-        # Try Content-Type name parameter if still no filename
-        if not filename:
-            content_type = part.get('Content-Type', '')
-            print(f"Content-Type: {content_type}")
-            
-            type_params = {}
-            for item in content_type.split(';'):
-                item = item.strip()
-                if '=' in item:
-                    name, value = item.split('=', 1) 
-                    # Strip quotes
-                    if value.startswith('"') and value.endswith('"'):
-                        value = value[1:-1]
-                    type_params[name.lower()] = value
-            
-            if 'name' in type_params:
-                filename = type_params['name']
-                print(f"Found filename in Content-Type params: {filename}")
-        
-        # Try standard get_filename method as last resort
-        if not filename:
-            filename = part.get_filename()
-            if filename:
-                print(f"Found filename with get_filename(): {filename}")
-        
-        # Try to guess from content type if still no filename
-        if not filename:
-            # Check if it looks like an attachment by content type
-            content_type = part.get_content_type()
-            is_likely_attachment = False
-            
-            # Check against common attachment types
-            for att_type in attachment_types:
-                if att_type in content_type:
-                    is_likely_attachment = True
-                    break
-            
-            if is_likely_attachment:
-                # Make a filename based on content type
-                ext = content_type.split('/')[-1].replace('jpeg', 'jpg')
-                filename = f"attachment_{len(attachments)+1}.{ext}"
-                print(f"Generated filename from content-type: {filename}")
-        
-        # If we managed to identify a filename, treat it as attachment
-        if filename:
-            payload = part.get_payload(decode=True)
-            if payload:
-                payload_size = len(payload)
-                print(f"Found attachment with fallback method: {filename}, size={payload_size} bytes")
-                
-                # Create temporary file
-                temp_dir = tempfile.gettempdir()
-                file_path = os.path.join(temp_dir, filename)
-                
-                # Save attachment data
-                with open(file_path, 'wb') as f:
-                    f.write(payload)
-                
-                print(f"Saved attachment to: {file_path}")
-                
-                # Add to list
-                attachments.append({
-                    'filename': filename,
-                    'path': file_path,
-                    'content_type': part.get_content_type(),
-                    'size': payload_size
-                })
-            else:
-                print(f"Warning: No payload for potential attachment: {filename}")
-    
-    print(f"Fallback method found {len(attachments)} attachment(s)")
-    return attachments 
\ No newline at end of file
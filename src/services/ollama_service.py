@@ -1,15 +1,67 @@
+import atexit
 import ollama
 import requests
 import re
 from typing import Optional
 from ..config.settings import OLLAMA_API_URL, OLLAMA_MODEL
 
+# Shared HTTP session so repeated calls to the Ollama server reuse the connection
+_session = requests.Session()
+atexit.register(_session.close)
+
+# Seconds to wait for Ollama (generation on a local model can be slow)
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_TAGS_TIMEOUT = 10
+OLLAMA_GENERATE_TIMEOUT = 120
+
+# Shared ollama client pointed at the configured server (keeps its connection open too)
+_client = ollama.Client(host=OLLAMA_API_URL, timeout=OLLAMA_GENERATE_TIMEOUT)
+
+# Instructions sent with every response to be polished (filled in by process_with_deepseek)
+DEEPSEEK_PROMPT_TEMPLATE = """
+    You are a professional customer support agent from StudyFate. Provide a direct, concise, and helpful response.
+    
+    Original customer query:
+    {original_query}
+    
+    Support agent's response:
+    {response_text}
+    
+    Your task:
+    1. Improve the response to be more helpful, professional, and empathetic.
+    2. Maintain the key information from the original response.
+    3. Ensure the tone is consistent with our brand and the response is clear and concise.
+    4. Format any bullet points with proper line breaks.
+    5. Provide ONLY the improved response text without any explanations, thoughts, or formatting markers.
+    6. DO NOT include any greeting or signature - these will be added automatically.
+    7. DO NOT include any <think> sections, meta-commentary, or notes to yourself.
+    """
+
+# Maximum characters of the customer query included in the prompt
+MAX_QUERY_CHARS = 1000
+
+# Patterns used by clean_ollama_response
+# Thinking sections and formatting markers are dropped wherever they appear
+CLEANUP_RE = re.compile(r'<think>.*?</think>|---|```', re.DOTALL)
+# Common prefixes that models like to add (possibly several in a row)
+RESPONSE_PREFIXES = (
+    "Here's an improved response:",
+    "Here is the improved response:",
+    "Improved response:",
+    "I would respond with:",
+    "I would say:",
+    "Response:",
+)
+RESPONSE_PREFIX_RE = re.compile(r'^\s*(?:(?:' + '|'.join(map(re.escape, RESPONSE_PREFIXES)) + r')\s*)*')
+DEAR_CUSTOMER_RE = re.compile(r'^Dear Customer,?\s*', re.IGNORECASE)
+TEAM_SIGNOFF_RE = re.compile(r'Thanks,?\s*The StudyFate Team\s*$', re.IGNORECASE)
+
 def test_ollama_connection() -> bool:
     """Test if the Ollama server is reachable and the model is available"""
     try:
         print(f"Testing connection to Ollama server at {OLLAMA_API_URL}...")
         # Try a basic request to get model list
-        response = requests.get(f"{OLLAMA_API_URL}/api/tags")
+        response = _session.get(f"{OLLAMA_API_URL}/api/tags", timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_TAGS_TIMEOUT))
         if response.status_code != 200:
             print(f"Error connecting to Ollama: HTTP status {response.status_code}")
             return False
@@ -35,28 +87,10 @@ def process_with_deepseek(original_query: str, response_text: str) -> str:
     print(f"Processing response with Ollama model {OLLAMA_MODEL} via {OLLAMA_API_URL}...")
     
     # Shorten the original query if it's too long
-    max_len = 1000
-    if len(original_query) > max_len:
-        original_query = original_query[:max_len] + "..."
-    
-    prompt = f"""
-    You are a professional customer support agent from StudyFate. Provide a direct, concise, and helpful response.
+    if len(original_query) > MAX_QUERY_CHARS:
+        original_query = original_query[:MAX_QUERY_CHARS] + "..."
     
-    Original customer query:
-    {original_query}
-    
-    Support agent's response:
-    {response_text}
-    
-    Your task:
-    1. Improve the response to be more helpful, professional, and empathetic.
-    2. Maintain the key information from the original response.
-    3. Ensure the tone is consistent with our brand and the response is clear and concise.
-    4. Format any bullet points with proper line breaks.
-    5. Provide ONLY the improved response text without any explanations, thoughts, or formatting markers.
-    6. DO NOT include any greeting or signature - these will be added automatically.
-    7. DO NOT include any <think> sections, meta-commentary, or notes to yourself.
-    """
+    prompt = DEEPSEEK_PROMPT_TEMPLATE.format_map({'original_query': original_query, 'response_text': response_text})
     
     try:
         print(f"Sending request to Ollama at {OLLAMA_API_URL} using model {OLLAMA_MODEL}...")
@@ -69,7 +103,11 @@ def process_with_deepseek(original_query: str, response_text: str) -> str:
                 "prompt": prompt,
                 "stream": False
             }
-            response = requests.post(f"{OLLAMA_API_URL}/api/generate", json=payload)
+            response = _session.post(
+                f"{OLLAMA_API_URL}/api/generate",
+                json=payload,
+                timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_GENERATE_TIMEOUT)
+            )
             if response.status_code != 200:
                 raise Exception(f"HTTP Error {response.status_code}: {response.text}")
                 
@@ -77,7 +115,7 @@ def process_with_deepseek(original_query: str, response_text: str) -> str:
             improved_response = result.get('response', '')
         else:
             # Use ollama library
-            response = ollama.chat(model=OLLAMA_MODEL, messages=[
+            response = _client.chat(model=OLLAMA_MODEL, messages=[
                 {"role": "user", "content": prompt}
             ])
             improved_response = response['message']['content']
@@ -98,30 +136,12 @@ def process_with_deepseek(original_query: str, response_text: str) -> str:
 
 def clean_ollama_response(response: str) -> str:
     """Clean up the response from Ollama"""
-    # Remove any thinking sections
-    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
-    
-    # Remove common prefixes that models like to add
-    prefixes_to_remove = [
-        "Here's an improved response:",
-        "Here is the improved response:",
-        "Improved response:",
-        "I would respond with:",
-        "I would say:",
-        "Response:",
-        "---",
-        "```"
-    ]
-    
-    for prefix in prefixes_to_remove:
-        if response.strip().startswith(prefix):
-            response = response.replace(prefix, "", 1).strip()
-    
-    # Remove any trailing formatting markers
-    response = response.replace("---", "").replace("```", "")
+    # Remove thinking sections and formatting markers, then any leading prefixes
+    response = CLEANUP_RE.sub('', response)
+    response = RESPONSE_PREFIX_RE.sub('', response, count=1)
     
     # Remove Dear Customer or Thanks from AI output if it added them anyway
-    response = re.sub(r'^Dear Customer,?\s*', '', response, flags=re.IGNORECASE)
-    response = re.sub(r'Thanks,?\s*The StudyFate Team\s*$', '', response, flags=re.IGNORECASE)
+    response = DEAR_CUSTOMER_RE.sub('', response)
+    response = TEAM_SIGNOFF_RE.sub('', response)
     
     return response.strip() 
\ No newline at end of file
@@ -2,17 +2,197 @@
 OpenRouter API Service
 Handles communication with OpenRouter for AI model inference
 """
+import atexit
+import hashlib
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
-from typing import Optional, Dict, Any, List
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional, Dict, Any, List
 from ..config.settings import (
     OPENROUTER_API_KEY,
     OPENROUTER_BASE_URL,
     OPENROUTER_CLASSIFIER_MODEL,
-    OPENROUTER_RESPONSE_MODEL
+    OPENROUTER_RESPONSE_MODEL,
+    OPENROUTER_MAX_CONCURRENCY
 )
 
+# Shared HTTP session so repeated API calls reuse the same keep-alive connection
+_session = requests.Session()
+_session.headers.update({
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "HTTP-Referer": "https://github.com/email-support-system",
+    "X-Title": "Email Support System"
+})
+# Keep as many idle connections as requests may run at once (requests' default pool holds 10)
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(OPENROUTER_MAX_CONCURRENCY, 10)))
+atexit.register(_session.close)
+
+# Responses that mean the API wants us to slow down
+THROTTLE_STATUS_CODES = {429, 502, 503, 504}
+# Transient errors worth retrying, with exponential backoff (1s, 2s, ...) capped at RETRY_MAX_DELAY
+RETRY_STATUS_CODES = THROTTLE_STATUS_CODES | {500}
+OPENROUTER_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Concurrency limit tuned by AIMD: halved whenever a request is throttled or times out,
+    raised by one after a run of successful requests, up to the configured maximum
+    """
+    
+    def __init__(self, maximum: int, minimum: int = 1, increase_after: int = 10):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = self.maximum
+        self.increase_after = increase_after
+        self._in_use = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+    
+    def __enter__(self):
+        with self._condition:
+            while self._in_use >= self.limit:
+                self._condition.wait()
+            self._in_use += 1
+        return self
+    
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+    
+    def on_success(self) -> None:
+        """Record a successful request"""
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+    
+    def on_throttle(self) -> None:
+        """Record a throttled or timed-out request"""
+        with self._condition:
+            self._successes = 0
+            limit = max(self.minimum, self.limit // 2)
+            if limit != self.limit:
+                print(f"⚠️ OpenRouter is throttling, reducing concurrent requests to {limit}")
+                self.limit = limit
+
+
+# Shared by every OpenRouter request, so classifier workers back off together
+_request_limit = AdaptiveConcurrencyLimit(OPENROUTER_MAX_CONCURRENCY)
+
+# Models that answered HTTP 400 to a json_schema response format
+_schema_unsupported_models = set()
+# What a 400 has to mention to count as a rejection of the schema rather than of the request itself
+SCHEMA_ERROR_MARKERS = ("response_format", "json_schema", "structured output", "schema")
+
+# Markdown code fence some models wrap their JSON in despite json_mode
+JSON_CODE_BLOCK_RE = re.compile(r'```(?:json)?\s*([\s\S]*?)\s*```')
+
+# Patterns used by clean_ai_response
+# Thinking sections and formatting markers are dropped wherever they appear
+CLEANUP_RE = re.compile(r'<think>.*?</think>|---|```', re.DOTALL)
+# Common prefixes that models like to add (possibly several in a row)
+RESPONSE_PREFIXES = (
+    "Here's an improved response:",
+    "Here is the improved response:",
+    "Here's my response:",
+    "Response:",
+)
+RESPONSE_PREFIX_RE = re.compile(r'^\s*(?:(?:' + '|'.join(map(re.escape, RESPONSE_PREFIXES)) + r')\s*)*')
+# "Dear Customer," / "Hello Name," / "Hi Name," / "Dear Name," / "Hey Name," at the start
+GREETING_RE = re.compile(r'^(?:(?:Dear Customer|(?:Hello|Hi|Dear|Hey)\s+\w+),?\s*)+', re.IGNORECASE)
+TEAM_SIGNOFF_RE = re.compile(r'Thanks,?\s*The StudyFate Team\s*$', re.IGNORECASE)
+SIGNOFF_LINE_RE = re.compile(r'(?:Best regards|Sincerely),?\s*.*$', re.IGNORECASE | re.MULTILINE)
+
+# Model families whose providers need cache_control breakpoints for prompt caching
+# (OpenAI-style providers cache identical prompt prefixes automatically)
+EXPLICIT_CACHE_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+# Exact-match cache of responses, keyed by a hash of the request payload:
+# {key: (stored_at, content)}, least recently used first
+RESPONSE_CACHE_SIZE = 1024
+# Structured (classification) requests are deterministic enough to reuse for a day
+STRUCTURED_RESPONSE_CACHE_TTL = 24 * 3600
+_response_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def _build_messages(model: str, system_prompt: Optional[str], prompt: str) -> List[Dict[str, Any]]:
+    """Build the chat messages for a request"""
+    messages = []
+    if system_prompt:
+        if model.startswith(EXPLICIT_CACHE_MODEL_PREFIXES):
+            # These providers only cache prompt prefixes marked with cache_control
+            messages.append({"role": "system", "content": [
+                {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+            ]})
+        else:
+            messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _is_schema_rejection(response) -> bool:
+    """Whether a 400 complains about the json_schema response format (not e.g. the prompt's length)"""
+    body = response.text.lower()
+    return any(marker in body for marker in SCHEMA_ERROR_MARKERS)
+
+
+def _retry_delay(response, attempt: int) -> float:
+    """Seconds to wait before the next attempt (the server's Retry-After wins when given)"""
+    try:
+        delay = float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        delay = RETRY_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+    return min(max(delay, 0.0), RETRY_MAX_DELAY)
+
+
+def _response_cache_key(payload: Dict[str, Any]) -> str:
+    """Hash a request payload into a cache key"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _get_cached_response(key: str, ttl: float) -> Optional[str]:
+    """Return a cached response younger than ttl seconds, if any"""
+    with _response_cache_lock:
+        cached = _response_cache.get(key)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[0] >= ttl:
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return cached[1]
+
+
+def _cache_response(key: str, content: str) -> None:
+    """Remember a response, evicting the least recently used one when full"""
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic(), content)
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+def _is_json_response(content: str) -> bool:
+    """Whether content is JSON, possibly wrapped in a markdown code block"""
+    json_match = JSON_CODE_BLOCK_RE.search(content)
+    try:
+        json.loads(json_match.group(1) if json_match else content)
+        return True
+    except json.JSONDecodeError:
+        return False
+
 
 def test_openrouter_connection() -> bool:
     """Test if the OpenRouter API is reachable"""
@@ -22,11 +202,7 @@ def test_openrouter_connection() -> bool:
             return False
             
         print(f"Testing connection to OpenRouter...")
-        response = requests.get(
-            f"{OPENROUTER_BASE_URL}/models",
-            headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}"},
-            timeout=10
-        )
+        response = _session.get(f"{OPENROUTER_BASE_URL}/models", timeout=10)
         
         if response.status_code == 200:
             print("✅ OpenRouter connection successful")
@@ -44,7 +220,10 @@ def call_openrouter(
     model: str = None,
     system_prompt: str = None,
     json_mode: bool = False,
-    max_tokens: int = 1024
+    max_tokens: int = 1024,
+    json_schema: Optional[Dict[str, Any]] = None,
+    temperature: Optional[float] = None,
+    cache_ttl: Optional[float] = None
 ) -> Optional[str]:
     """
     Make a request to OpenRouter API
@@ -55,6 +234,11 @@ def call_openrouter(
         system_prompt: Optional system prompt
         json_mode: Whether to request JSON output
         max_tokens: Maximum tokens in response
+        json_schema: Optional JSON schema the output must follow (falls back to
+            json_mode for models that reject structured outputs)
+        temperature: Optional sampling temperature
+        cache_ttl: Reuse an identical request's response for this many seconds
+            (None disables caching)
         
     Returns:
         The model's response text or None on error
@@ -65,36 +249,62 @@ def call_openrouter(
         
     model = model or OPENROUTER_RESPONSE_MODEL
     
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://github.com/email-support-system",
-        "X-Title": "Email Support System"
-    }
-    
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": prompt})
-    
     payload = {
         "model": model,
-        "messages": messages,
+        "messages": _build_messages(model, system_prompt, prompt),
         "max_tokens": max_tokens,
     }
     
-    # Add response format for JSON mode
-    if json_mode:
+    # Add response format for schema-constrained output or JSON mode
+    use_schema = json_schema is not None and model not in _schema_unsupported_models
+    if use_schema:
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "result", "strict": True, "schema": json_schema}
+        }
+    elif json_mode:
         payload["response_format"] = {"type": "json_object"}
     
+    if temperature is not None:
+        payload["temperature"] = temperature
+    
+    cache_key = None
+    if cache_ttl:
+        cache_key = _response_cache_key(payload)
+        cached = _get_cached_response(cache_key, cache_ttl)
+        if cached is not None:
+            print(f"Using cached OpenRouter response for model: {model}")
+            return cached
+    
     try:
         print(f"Calling OpenRouter with model: {model}")
-        response = requests.post(
-            f"{OPENROUTER_BASE_URL}/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=60
-        )
+        for attempt in range(1, OPENROUTER_MAX_ATTEMPTS + 1):
+            with _request_limit:
+                response = _session.post(
+                    f"{OPENROUTER_BASE_URL}/chat/completions",
+                    json=payload,
+                    timeout=60
+                )
+            
+            if response.status_code in THROTTLE_STATUS_CODES:
+                _request_limit.on_throttle()
+            elif response.status_code == 200:
+                _request_limit.on_success()
+            
+            if response.status_code not in RETRY_STATUS_CODES or attempt == OPENROUTER_MAX_ATTEMPTS:
+                break
+            
+            # Transient error: back off (outside the concurrency limit) and try again
+            delay = _retry_delay(response, attempt)
+            print(f"⚠️ OpenRouter returned HTTP {response.status_code}, retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 1}/{OPENROUTER_MAX_ATTEMPTS})")
+            time.sleep(delay)
+        
+        if response.status_code == 400 and use_schema and _is_schema_rejection(response):
+            # Model/provider doesn't accept json_schema: remember that and use plain JSON mode
+            print(f"⚠️ {model} rejected a JSON schema, retrying with JSON mode")
+            _schema_unsupported_models.add(model)
+            return call_openrouter(prompt, model, system_prompt, True, max_tokens, None, temperature, cache_ttl)
         
         if response.status_code != 200:
             print(f"❌ OpenRouter API error: HTTP {response.status_code}")
@@ -104,21 +314,128 @@ def call_openrouter(
         result = response.json()
         content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
         
+        cached_tokens = ((result.get("usage") or {}).get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached_tokens:
+            print(f"OpenRouter served {cached_tokens} prompt tokens from the provider cache")
+        
+        # Don't keep JSON requests' malformed answers, so a retry can do better
+        if cache_key and content and (not payload.get("response_format") or _is_json_response(content)):
+            _cache_response(cache_key, content)
         return content
         
+    except requests.exceptions.Timeout as e:
+        _request_limit.on_throttle()
+        print(f"❌ OpenRouter request timed out: {e}")
+        return None
     except Exception as e:
         print(f"❌ Error calling OpenRouter: {e}")
         return None
 
 
+class StreamInterruptedError(Exception):
+    """A streamed response stopped before the model finished (connection lost or provider error)"""
+
+
+def call_openrouter_stream(
+    prompt: str,
+    model: str = None,
+    system_prompt: str = None,
+    max_tokens: int = 1024,
+    temperature: Optional[float] = None
+) -> Iterator[str]:
+    """
+    Make a streaming request to OpenRouter API and yield the response text as it arrives
+    
+    Yields nothing when the request fails (errors are printed, like call_openrouter).
+    Raises StreamInterruptedError if the stream breaks off after it has started, so the
+    caller can discard the partial text.
+    """
+    if not OPENROUTER_API_KEY:
+        print("❌ OpenRouter API key not configured")
+        return
+    
+    model = model or OPENROUTER_RESPONSE_MODEL
+    payload = {
+        "model": model,
+        "messages": _build_messages(model, system_prompt, prompt),
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+    if temperature is not None:
+        payload["temperature"] = temperature
+    
+    started = False
+    try:
+        print(f"Streaming from OpenRouter with model: {model}")
+        with _request_limit:
+            with _session.post(
+                f"{OPENROUTER_BASE_URL}/chat/completions",
+                json=payload,
+                timeout=60,
+                stream=True
+            ) as response:
+                if response.status_code in THROTTLE_STATUS_CODES:
+                    _request_limit.on_throttle()
+                if response.status_code != 200:
+                    print(f"❌ OpenRouter API error: HTTP {response.status_code}")
+                    print(f"Response: {response.text}")
+                    return
+                _request_limit.on_success()
+                started = True
+                
+                # Server-sent events: "data: {json}" lines, ": comment" keep-alives, "data: [DONE]" at the end
+                finished = False
+                # SSE is always UTF-8, but requests would decode text/event-stream as ISO-8859-1
+                # (and split lines at latin-1 line breaks), so lines are split as bytes and decoded here
+                for raw_line in response.iter_lines():
+                    line = raw_line.decode("utf-8")
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = line[6:]
+                    if data == "[DONE]":
+                        finished = True
+                        break
+                    event = json.loads(data)
+                    if event.get("error"):
+                        raise StreamInterruptedError(f"provider error: {event['error']}")
+                    choice = (event.get("choices") or [{}])[0]
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
+                    finish_reason = choice.get("finish_reason")
+                    if finish_reason == "error":
+                        raise StreamInterruptedError("provider reported finish_reason=error")
+                    if finish_reason:
+                        finished = True
+                
+                if not finished:
+                    raise StreamInterruptedError("stream ended before the response was complete")
+    except StreamInterruptedError:
+        raise
+    except requests.exceptions.Timeout as e:
+        _request_limit.on_throttle()
+        if started:
+            raise StreamInterruptedError(f"timed out: {e}") from e
+        print(f"❌ OpenRouter request timed out: {e}")
+    except Exception as e:
+        if started:
+            raise StreamInterruptedError(str(e)) from e
+        print(f"❌ Error streaming from OpenRouter: {e}")
+
+
 def call_openrouter_structured(
     prompt: str,
     model: str = None,
     system_prompt: str = None,
-    max_tokens: int = 1024
+    max_tokens: int = 1024,
+    json_schema: Optional[Dict[str, Any]] = None,
+    temperature: Optional[float] = None,
+    cache_ttl: Optional[float] = STRUCTURED_RESPONSE_CACHE_TTL
 ) -> Optional[Dict[str, Any]]:
     """
     Make a request to OpenRouter API and parse JSON response
+    (constrained to json_schema when given and supported by the model;
+    identical requests are answered from the response cache for cache_ttl seconds)
     
     Returns:
         Parsed JSON dict or None on error
@@ -130,16 +447,24 @@ def call_openrouter_structured(
         model=model,
         system_prompt=system_prompt,
         json_mode=True,
-        max_tokens=max_tokens
+        max_tokens=max_tokens,
+        json_schema=json_schema,
+        temperature=temperature,
+        cache_ttl=cache_ttl
     )
     
     if not response:
         return None
         
     try:
-        # Try to parse JSON from response
+        # json_mode responses are normally plain JSON, so parse directly first
+        return json.loads(response)
+    except json.JSONDecodeError:
+        pass
+    
+    try:
         # Sometimes models wrap JSON in markdown code blocks
-        json_match = re.search(r'```(?:json)?\s*([\s\S]*?)\s*```', response)
+        json_match = JSON_CODE_BLOCK_RE.search(response)
         if json_match:
             response = json_match.group(1)
         
@@ -153,10 +478,27 @@ def call_openrouter_structured(
         return None
 
 
+# Streamed drafts are reported to on_progress roughly every 50 tokens
+STREAM_PROGRESS_CHARS = 200
+
+# Instructions for drafting customer replies (identical on every call, so providers can cache it)
+RESPONSE_SYSTEM_PROMPT = """You are a professional customer support agent for StudyFate. 
+Your task is to provide helpful, empathetic, and accurate responses to customer inquiries.
+
+Guidelines:
+- Be professional yet friendly
+- Address the customer's concerns directly
+- If you have context from the knowledge base, use it accurately
+- Keep responses concise but complete
+- DO NOT include greetings like "Dear Customer" or signatures - these are added automatically
+- DO NOT include any meta-commentary or thinking sections"""
+
+
 def generate_ai_response(
     customer_query: str,
     context: str = "",
-    draft_response: str = ""
+    draft_response: str = "",
+    on_progress: Optional[Callable[[str], None]] = None
 ) -> str:
     """
     Generate an AI response for a customer query
@@ -165,22 +507,14 @@ def generate_ai_response(
         customer_query: The customer's email content
         context: RAG context from knowledge base
         draft_response: Optional draft to improve
+        on_progress: Optional callback; when given the response is streamed and the
+            callback receives the text so far every STREAM_PROGRESS_CHARS characters
         
     Returns:
         The AI-generated response
     """
-    system_prompt = """You are a professional customer support agent for StudyFate. 
-Your task is to provide helpful, empathetic, and accurate responses to customer inquiries.
-
-Guidelines:
-- Be professional yet friendly
-- Address the customer's concerns directly
-- If you have context from the knowledge base, use it accurately
-- Keep responses concise but complete
-- DO NOT include greetings like "Dear Customer" or signatures - these are added automatically
-- DO NOT include any meta-commentary or thinking sections"""
-
-    # Build the prompt
+    # Build the prompt: the knowledge base context comes first and the customer's text last,
+    # so requests share as long a prefix as possible for provider-side prompt caching
     prompt_parts = []
     
     if context:
@@ -196,12 +530,30 @@ Guidelines:
     
     prompt = "\n".join(prompt_parts)
     
-    response = call_openrouter(
-        prompt=prompt,
-        model=OPENROUTER_RESPONSE_MODEL,
-        system_prompt=system_prompt,
-        max_tokens=1024
-    )
+    response = None
+    if on_progress:
+        parts = []
+        reported_length = 0
+        length = 0
+        try:
+            for text in call_openrouter_stream(prompt, OPENROUTER_RESPONSE_MODEL, RESPONSE_SYSTEM_PROMPT, max_tokens=1024):
+                parts.append(text)
+                length += len(text)
+                if length - reported_length >= STREAM_PROGRESS_CHARS:
+                    reported_length = length
+                    on_progress("".join(parts))
+            response = "".join(parts)
+        except StreamInterruptedError as e:
+            # Never offer a truncated draft; ask again without streaming
+            print(f"❌ OpenRouter stream interrupted, discarding partial response: {e}")
+    
+    if not response:
+        response = call_openrouter(
+            prompt=prompt,
+            model=OPENROUTER_RESPONSE_MODEL,
+            system_prompt=RESPONSE_SYSTEM_PROMPT,
+            max_tokens=1024
+        )
     
     if response:
         # Clean up the response
@@ -213,34 +565,13 @@ Guidelines:
 
 def clean_ai_response(response: str) -> str:
     """Clean up the AI response"""
-    # Remove any thinking sections
-    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
-    
-    # Remove common prefixes
-    prefixes_to_remove = [
-        "Here's an improved response:",
-        "Here is the improved response:",
-        "Here's my response:",
-        "Response:",
-        "---",
-        "```"
-    ]
-    
-    for prefix in prefixes_to_remove:
-        if response.strip().startswith(prefix):
-            response = response.replace(prefix, "", 1).strip()
-    
-    # Remove trailing markers
-    response = response.replace("---", "").replace("```", "")
+    # Remove thinking sections and formatting markers, then any leading prefixes
+    response = CLEANUP_RE.sub('', response)
+    response = RESPONSE_PREFIX_RE.sub('', response, count=1)
     
     # Remove greetings/signatures if AI added them anyway
-    response = re.sub(r'^Dear Customer,?\s*', '', response, flags=re.IGNORECASE)
-    response = re.sub(r'^Hello\s+\w+,?\s*', '', response, flags=re.IGNORECASE)  # Remove "Hello Name,"
-    response = re.sub(r'^Hi\s+\w+,?\s*', '', response, flags=re.IGNORECASE)     # Remove "Hi Name,"
-    response = re.sub(r'^Dear\s+\w+,?\s*', '', response, flags=re.IGNORECASE)   # Remove "Dear Name,"
-    response = re.sub(r'^Hey\s+\w+,?\s*', '', response, flags=re.IGNORECASE)    # Remove "Hey Name,"
-    response = re.sub(r'Thanks,?\s*The StudyFate Team\s*$', '', response, flags=re.IGNORECASE)
-    response = re.sub(r'Best regards,?\s*.*$', '', response, flags=re.IGNORECASE | re.MULTILINE)
-    response = re.sub(r'Sincerely,?\s*.*$', '', response, flags=re.IGNORECASE | re.MULTILINE)
+    response = GREETING_RE.sub('', response, count=1)
+    response = TEAM_SIGNOFF_RE.sub('', response)
+    response = SIGNOFF_LINE_RE.sub('', response)
     
     return response.strip()
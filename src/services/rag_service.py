@@ -5,12 +5,47 @@ Handles document loading, chunking, and retrieval for knowledge-based responses
 import os
 import re
 import json
+import heapq
+import math
+from collections import Counter
 from typing import List, Dict, Optional, Tuple
 from dataclasses import dataclass
 from pathlib import Path
 from ..config.settings import RAG_KNOWLEDGE_DIR, RAG_CHUNK_SIZE, RAG_CHUNK_OVERLAP
 
 
+# Words ignored when matching queries against the knowledge base
+STOP_WORDS = frozenset({
+    'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been', 'being',
+    'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could',
+    'should', 'may', 'might', 'must', 'can', 'to', 'of', 'in', 'for',
+    'on', 'with', 'at', 'by', 'from', 'as', 'into', 'through', 'during',
+    'before', 'after', 'above', 'below', 'between', 'under', 'again',
+    'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why',
+    'how', 'all', 'each', 'few', 'more', 'most', 'other', 'some', 'such',
+    'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very',
+    'just', 'and', 'but', 'if', 'or', 'because', 'until', 'while', 'this',
+    'that', 'these', 'those', 'what', 'which', 'who', 'whom', 'i', 'you',
+    'he', 'she', 'it', 'we', 'they', 'me', 'him', 'her', 'us', 'them', 'my',
+    'your', 'his', 'its', 'our', 'their', 'please', 'help', 'need', 'want'
+})
+WORD_RE = re.compile(r'\b[a-z]+\b')
+PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+
+# BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+@dataclass
+class SearchIndex:
+    """Inverted index over the chunks for BM25 scoring"""
+    postings: Dict[str, Dict[int, int]]  # term -> {chunk index: term frequency}
+    idf: Dict[str, float]
+    lengths: List[int]  # number of terms in each chunk
+    average_length: float
+
+
 @dataclass
 class DocumentChunk:
     """A chunk of text from a document"""
@@ -20,6 +55,15 @@ class DocumentChunk:
     metadata: Dict
 
 
+@dataclass
+class LoadedFile:
+    """A knowledge base file as last loaded, reused while its mtime is unchanged"""
+    mtime: float
+    length: int  # characters of text loaded (only the chunks keep the text itself)
+    chunks: List[DocumentChunk]
+    chunk_terms: List[Counter]  # term counts of each chunk, for the search index
+
+
 @dataclass 
 class RetrievalResult:
     """Result of a retrieval query"""
@@ -30,14 +74,16 @@ class RetrievalResult:
 
 class SimpleRAGService:
     """
-    Simple RAG implementation using keyword matching
+    Simple RAG implementation using keyword matching (BM25 over an inverted index)
     For production, consider using vector embeddings with a proper vector DB
     """
     
     def __init__(self, knowledge_dir: str = None):
         self.knowledge_dir = knowledge_dir or RAG_KNOWLEDGE_DIR
         self.chunks: List[DocumentChunk] = []
-        self.documents: Dict[str, str] = {}
+        self.documents: Dict[str, int] = {}  # loaded file -> characters of text
+        self.index = SearchIndex(postings={}, idf={}, lengths=[], average_length=0.0)
+        self._files: Dict[str, LoadedFile] = {}
         self._loaded = False
         
     def ensure_knowledge_dir(self):
@@ -76,16 +122,17 @@ This folder contains documents that the AI can reference when responding to cust
             print(f"✅ Created sample knowledge base document: {sample_path}")
     
     def load_documents(self) -> int:
-        """Load all documents from the knowledge directory"""
+        """Load all documents from the knowledge directory (files unchanged since the last load are reused)"""
         self.ensure_knowledge_dir()
         
-        self.documents = {}
-        self.chunks = []
+        # Build everything aside and swap it in at the end, so searches running meanwhile
+        # keep using the previous documents
+        files: Dict[str, LoadedFile] = {}
         
         supported_extensions = {'.txt', '.md', '.json'}
         
-        for root, dirs, files in os.walk(self.knowledge_dir):
-            for filename in files:
+        for root, dirs, filenames in os.walk(self.knowledge_dir):
+            for filename in filenames:
                 ext = os.path.splitext(filename)[1].lower()
                 if ext not in supported_extensions:
                     continue
@@ -94,22 +141,47 @@ This folder contains documents that the AI can reference when responding to cust
                 rel_path = os.path.relpath(filepath, self.knowledge_dir)
                 
                 try:
+                    mtime = os.path.getmtime(filepath)
+                    loaded = self._files.get(rel_path)
+                    if loaded and loaded.mtime == mtime:
+                        files[rel_path] = loaded
+                        continue
+                    
                     content = self._load_file(filepath, ext)
                     if content:
-                        self.documents[rel_path] = content
+                        chunks = self._chunk_text(content, rel_path)
+                        chunk_terms = [Counter(self._extract_keywords(chunk.content.lower())) for chunk in chunks]
+                        files[rel_path] = LoadedFile(mtime=mtime, length=len(content), chunks=chunks, chunk_terms=chunk_terms)
                         print(f"📄 Loaded: {rel_path} ({len(content)} chars)")
                 except Exception as e:
                     print(f"❌ Error loading {filepath}: {e}")
         
-        # Chunk all documents
-        for source, content in self.documents.items():
-            doc_chunks = self._chunk_text(content, source)
-            self.chunks.extend(doc_chunks)
+        chunks = [chunk for loaded in files.values() for chunk in loaded.chunks]
+        chunk_terms = [terms for loaded in files.values() for terms in loaded.chunk_terms]
+        documents = {rel_path: loaded.length for rel_path, loaded in files.items()}
         
+        self.index, self.chunks, self.documents, self._files = self._build_index(chunk_terms), chunks, documents, files
         self._loaded = True
         print(f"✅ Loaded {len(self.documents)} documents, {len(self.chunks)} chunks")
         return len(self.documents)
     
+    def _build_index(self, chunk_terms: List[Counter]) -> SearchIndex:
+        """Build the inverted index from each chunk's term counts"""
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = []
+        for chunk_index, terms in enumerate(chunk_terms):
+            lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                postings.setdefault(term, {})[chunk_index] = frequency
+        
+        count = len(chunk_terms)
+        idf = {
+            term: math.log(1 + (count - len(matches) + 0.5) / (len(matches) + 0.5))
+            for term, matches in postings.items()
+        }
+        average_length = sum(lengths) / count if count else 0.0
+        return SearchIndex(postings=postings, idf=idf, lengths=lengths, average_length=average_length)
+    
     def _load_file(self, filepath: str, ext: str) -> Optional[str]:
         """Load a file based on its extension"""
         with open(filepath, 'r', encoding='utf-8') as f:
@@ -127,26 +199,35 @@ This folder contains documents that the AI can reference when responding to cust
     
     def _json_to_text(self, data, prefix="") -> str:
         """Convert JSON structure to readable text"""
-        lines = []
-        
+        lines: List[str] = []
+        self._json_to_lines(data, prefix, lines)
+        return "\n".join(lines)
+    
+    def _json_to_lines(self, data, prefix: str, lines: List[str]) -> None:
+        """Append the readable lines for a JSON structure to lines"""
         if isinstance(data, dict):
             for key, value in data.items():
                 if isinstance(value, (dict, list)):
                     lines.append(f"{prefix}{key}:")
-                    lines.append(self._json_to_text(value, prefix + "  "))
+                    self._json_nested_to_lines(value, prefix + "  ", lines)
                 else:
                     lines.append(f"{prefix}{key}: {value}")
         elif isinstance(data, list):
             for i, item in enumerate(data):
                 if isinstance(item, (dict, list)):
                     lines.append(f"{prefix}Item {i+1}:")
-                    lines.append(self._json_to_text(item, prefix + "  "))
+                    self._json_nested_to_lines(item, prefix + "  ", lines)
                 else:
                     lines.append(f"{prefix}- {item}")
         else:
             lines.append(f"{prefix}{data}")
-            
-        return "\n".join(lines)
+    
+    def _json_nested_to_lines(self, data, prefix: str, lines: List[str]) -> None:
+        """Append a nested structure's lines (an empty one still leaves a blank line)"""
+        start = len(lines)
+        self._json_to_lines(data, prefix, lines)
+        if len(lines) == start:
+            lines.append("")
     
     def _chunk_text(self, text: str, source: str) -> List[DocumentChunk]:
         """Split text into chunks with overlap"""
@@ -158,9 +239,11 @@ This folder contains documents that the AI can reference when responding to cust
             return chunks
         
         # Split by paragraphs first, then by sentences if needed
-        paragraphs = re.split(r'\n\s*\n', text)
+        paragraphs = PARAGRAPH_BREAK_RE.split(text)
         
-        current_chunk = ""
+        # Paragraphs of the chunk being built, joined with blank lines only when it is saved
+        current_parts: List[str] = []
+        current_len = 0
         chunk_id = 0
         
         for para in paragraphs:
@@ -169,8 +252,9 @@ This folder contains documents that the AI can reference when responding to cust
                 continue
                 
             # If adding this paragraph exceeds chunk size, save current and start new
-            if len(current_chunk) + len(para) > RAG_CHUNK_SIZE:
-                if current_chunk:
+            if current_len + len(para) > RAG_CHUNK_SIZE:
+                if current_parts:
+                    current_chunk = "\n\n".join(current_parts)
                     chunks.append(DocumentChunk(
                         content=current_chunk.strip(),
                         source=source,
@@ -182,18 +266,20 @@ This folder contains documents that the AI can reference when responding to cust
                     # Keep overlap from end of current chunk
                     if RAG_CHUNK_OVERLAP > 0:
                         overlap_text = current_chunk[-RAG_CHUNK_OVERLAP:]
-                        current_chunk = overlap_text + "\n\n" + para
+                        current_parts = [overlap_text, para]
+                        current_len = len(overlap_text) + 2 + len(para)
                     else:
-                        current_chunk = para
+                        current_parts = [para]
+                        current_len = len(para)
                 else:
-                    current_chunk = para
+                    current_parts = [para]
+                    current_len = len(para)
             else:
-                if current_chunk:
-                    current_chunk += "\n\n" + para
-                else:
-                    current_chunk = para
+                current_len += len(para) + (2 if current_parts else 0)
+                current_parts.append(para)
         
         # Don't forget the last chunk
+        current_chunk = "\n\n".join(current_parts)
         if current_chunk.strip():
             chunks.append(DocumentChunk(
                 content=current_chunk.strip(),
@@ -218,73 +304,44 @@ This folder contains documents that the AI can reference when responding to cust
         if not self._loaded:
             self.load_documents()
         
-        if not self.chunks:
+        chunks, index = self.chunks, self.index
+        if not chunks:
             return RetrievalResult(chunks=[], query=query, total_chunks_searched=0)
         
         # Extract keywords from query
-        keywords = self._extract_keywords(query.lower())
-        
-        # Score each chunk based on keyword matches
-        scored_chunks = []
-        for chunk in self.chunks:
-            score = self._score_chunk(chunk.content.lower(), keywords)
-            if score > 0:
-                scored_chunks.append((chunk, score))
+        keywords = set(self._extract_keywords(query.lower()))
         
-        # Sort by score descending
-        scored_chunks.sort(key=lambda x: x[1], reverse=True)
+        # Score only the chunks that contain at least one keyword
+        scores: Dict[int, float] = {}
+        for keyword in keywords:
+            matches = index.postings.get(keyword)
+            if not matches:
+                continue
+            idf = index.idf[keyword]
+            for chunk_index, frequency in matches.items():
+                length_norm = BM25_K1 * (1 - BM25_B + BM25_B * index.lengths[chunk_index] / index.average_length)
+                scores[chunk_index] = scores.get(chunk_index, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + length_norm)
         
         # Return top k
-        top_chunks = [chunk for chunk, score in scored_chunks[:top_k]]
+        top = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        top_chunks = [chunks[chunk_index] for chunk_index, score in top]
         
         return RetrievalResult(
             chunks=top_chunks,
             query=query,
-            total_chunks_searched=len(self.chunks)
+            total_chunks_searched=len(chunks)
         )
     
     def _extract_keywords(self, text: str) -> List[str]:
         """Extract keywords from text"""
-        # Remove common stop words
-        stop_words = {
-            'the', 'a', 'an', 'is', 'are', 'was', 'were', 'be', 'been', 'being',
-            'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could',
-            'should', 'may', 'might', 'must', 'can', 'to', 'of', 'in', 'for',
-            'on', 'with', 'at', 'by', 'from', 'as', 'into', 'through', 'during',
-            'before', 'after', 'above', 'below', 'between', 'under', 'again',
-            'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why',
-            'how', 'all', 'each', 'few', 'more', 'most', 'other', 'some', 'such',
-            'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very',
-            'just', 'and', 'but', 'if', 'or', 'because', 'until', 'while', 'this',
-            'that', 'these', 'those', 'what', 'which', 'who', 'whom', 'i', 'you',
-            'he', 'she', 'it', 'we', 'they', 'me', 'him', 'her', 'us', 'them', 'my',
-            'your', 'his', 'its', 'our', 'their', 'please', 'help', 'need', 'want'
-        }
-        
         # Tokenize
-        words = re.findall(r'\b[a-z]+\b', text)
+        words = WORD_RE.findall(text)
         
         # Filter stop words and short words
-        keywords = [w for w in words if w not in stop_words and len(w) > 2]
+        keywords = [w for w in words if w not in STOP_WORDS and len(w) > 2]
         
         return keywords
     
-    def _score_chunk(self, chunk_text: str, keywords: List[str]) -> float:
-        """Score a chunk based on keyword presence"""
-        if not keywords:
-            return 0.0
-            
-        matches = 0
-        for keyword in keywords:
-            if keyword in chunk_text:
-                matches += 1
-                # Bonus for exact word match (not just substring)
-                if re.search(rf'\b{re.escape(keyword)}\b', chunk_text):
-                    matches += 0.5
-        
-        # Normalize by number of keywords
-        return matches / len(keywords)
-    
     def get_context_for_query(self, query: str, max_tokens: int = 1000) -> str:
         """
         Get relevant context for a customer query
@@ -340,7 +397,7 @@ This folder contains documents that the AI can reference when responding to cust
             with open(filepath, 'w', encoding='utf-8') as f:
                 f.write(content)
             
-            # Reload documents
+            # Reload documents (only the new file is read and chunked)
             self.load_documents()
             return True
         except Exception as e:
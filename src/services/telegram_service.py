@@ -1,34 +1,72 @@
+import atexit
+import contextlib
+import functools
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
 import telebot
-from telebot import types
+from telebot import apihelper, types
 import re
 import time
 import os
-from typing import Optional, List, Dict
+import threading
+from typing import Optional, List, Dict, Tuple
 from ..config.settings import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID
 from ..services.db_service import update_ticket_status
 
+# One keep-alive session shared by every bot API call (messages, uploads and polling),
+# instead of telebot's per-thread sessions that are rebuilt every 10 minutes
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+atexit.register(_session.close)
+
 # Initialize bot
 bot = None
 running = True  # Default value
+# Set on shutdown; the polling loop checks it between polls and its error back-off returns at once,
+# but a getUpdates request already in progress runs until its long-poll timeout
+_stop_polling = threading.Event()
 
-# Store pending confirmations: {ticket_id: draft_response}
-pending_confirmations: Dict[str, str] = {}
+# Store pending confirmations: {ticket_id: (stored_at, draft_response)}, least recently set first.
+# Bounded so ignored drafts don't pile up; evicted drafts are still read back from the drafts table.
+MAX_PENDING_CONFIRMATIONS = 1000
+PENDING_CONFIRMATION_TTL = 24 * 60 * 60
+pending_confirmations: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_pending_lock = threading.Lock()
 
 
 def get_pending_confirmation(ticket_id: str) -> Optional[str]:
     """Get pending draft response for a ticket"""
-    return pending_confirmations.get(ticket_id)
+    with _pending_lock:
+        entry = pending_confirmations.get(ticket_id)
+        if not entry:
+            return None
+        if time.monotonic() - entry[0] > PENDING_CONFIRMATION_TTL:
+            del pending_confirmations[ticket_id]
+            return None
+        return entry[1]
 
 
 def set_pending_confirmation(ticket_id: str, draft: str):
-    """Set pending draft response for a ticket"""
-    pending_confirmations[ticket_id] = draft
+    """Set pending draft response for a ticket, dropping expired and least recent drafts"""
+    now = time.monotonic()
+    with _pending_lock:
+        pending_confirmations[ticket_id] = (now, draft)
+        pending_confirmations.move_to_end(ticket_id)
+        while pending_confirmations:
+            oldest_id, (stored_at, _) = next(iter(pending_confirmations.items()))
+            if len(pending_confirmations) <= MAX_PENDING_CONFIRMATIONS and now - stored_at <= PENDING_CONFIRMATION_TTL:
+                break
+            del pending_confirmations[oldest_id]
 
 
 def clear_pending_confirmation(ticket_id: str):
     """Clear pending confirmation for a ticket"""
-    if ticket_id in pending_confirmations:
-        del pending_confirmations[ticket_id]
+    with _pending_lock:
+        pending_confirmations.pop(ticket_id, None)
 
 
 def create_ticket_keyboard(ticket_id: str, has_draft: bool = False) -> types.InlineKeyboardMarkup:
@@ -63,6 +101,8 @@ def create_ticket_keyboard(ticket_id: str, has_draft: bool = False) -> types.Inl
 def initialize_telegram():
     """Initialize the Telegram bot"""
     global bot
+    apihelper.session = _session
+    apihelper.SESSION_TIME_TO_LIVE = None
     bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, threaded=False)
     
     # Set bot commands for menu display
@@ -81,6 +121,25 @@ def initialize_telegram():
     
     return bot
 
+# Patterns used by sanitize_telegram_markdown
+MARKDOWN_STRIP_TABLE = str.maketrans('', '', '*_`~>#+=|{}[]')
+# The lookbehind only lets a match start at the beginning of a token, so long
+# words without an address are scanned once instead of once per character
+EMAIL_TOKEN_RE = re.compile(r'(?<![^\s@])[^\s@]+@[^\s@]*\.\S*')
+WHITESPACE_RUN_RE = re.compile(r'\s{3,}')
+# Anything sanitize_telegram_markdown would change in ASCII text
+NEEDS_SANITIZE_RE = re.compile(r'[*_`~>#+=|{}\[\]]|\s{3,}|DOT')
+SANITIZE_MAX_LENGTH = 2000  # Conservative limit
+
+def _collapse_whitespace_run(match) -> str:
+    """Runs of only newlines become one blank line, any other long whitespace run two spaces"""
+    return '\n\n' if match.group(0).count('\n') == len(match.group(0)) else '  '
+
+# Short fields (addresses, subjects) are sanitized again on every /status and /list,
+# so their results are cached; long previews and drafts rarely repeat
+SANITIZE_CACHE_SIZE = 2048
+SANITIZE_CACHE_MAX_CHARS = 300
+
 def sanitize_telegram_markdown(text: str) -> str:
     """Very aggressive sanitization for Telegram Markdown formatting to avoid API errors."""
     if not text:
@@ -88,55 +147,65 @@ def sanitize_telegram_markdown(text: str) -> str:
         
     # Convert to string and make a copy for safety
     text = str(text)
+    if len(text) <= SANITIZE_CACHE_MAX_CHARS:
+        return _sanitize_short_text(text)
+    return _sanitize_text(text)
+
+def _sanitize_text(text: str) -> str:
+    """Sanitize a string for plain-text Telegram messages"""
+    # Most subjects and addresses have nothing to change: one scan and we're done
+    if len(text) <= SANITIZE_MAX_LENGTH and text.isascii() and not NEEDS_SANITIZE_RE.search(text):
+        return text
     
     # Replace DOT with . in case it's already been converted somewhere
     text = text.replace("DOT", ".")
     
-    # Now remove other special characters except email addresses
-    # We'll specially handle emails by preserving them exactly as they are
-    
-    # First extract and protect all email addresses with unique placeholders
-    cleaned_text = ""
-    i = 0
-    while i < len(text):
-        # Check if this might be the start of an email
-        if i < len(text) - 5 and '@' in text[i:i+20]:
-            # Look for email ending (space, newline, or end of string)
-            j = i
-            while j < len(text) and text[j] not in [' ', '\n', '\r']:
-                j += 1
-            
-            potential_email = text[i:j]
-            # Simple email validation
-            if '@' in potential_email and '.' in potential_email.split('@')[1]:
-                # This looks like an email, preserve it entirely
-                cleaned_text += potential_email
-                i = j
-                continue
-        
-        # Not an email, process char by char
-        if text[i] not in '*_`~>#+=|{}[]\n\r':
-            cleaned_text += text[i]
-        elif text[i] in ['\n', '\r']:
-            cleaned_text += text[i]  # Preserve newlines
-        i += 1
-    
-    # Replace any non-ASCII characters that might cause issues
-    cleaned_text = ''.join(c for c in cleaned_text if ord(c) < 128)
+    # Remove Markdown special characters everywhere except inside email addresses,
+    # which are kept exactly as they are
+    pieces = []
+    last = 0
+    for match in EMAIL_TOKEN_RE.finditer(text):
+        pieces.append(text[last:match.start()].translate(MARKDOWN_STRIP_TABLE))
+        pieces.append(match.group(0))
+        last = match.end()
+    pieces.append(text[last:].translate(MARKDOWN_STRIP_TABLE))
     
-    # Ensure no more than 2 consecutive newlines
-    cleaned_text = re.sub(r'\n{3,}', '\n\n', cleaned_text)
+    # Drop any non-ASCII characters that might cause issues
+    cleaned_text = ''.join(pieces)
+    if not cleaned_text.isascii():
+        cleaned_text = cleaned_text.encode('ascii', 'ignore').decode('ascii')
     
-    # Remove excessive spaces
-    cleaned_text = re.sub(r'\s{3,}', '  ', cleaned_text)
+    # At most 2 consecutive newlines, and no excessive spaces (one pass for both)
+    cleaned_text = WHITESPACE_RUN_RE.sub(_collapse_whitespace_run, cleaned_text)
     
     # Limit text length
-    max_length = 2000  # Conservative limit
-    if len(cleaned_text) > max_length:
-        cleaned_text = cleaned_text[:max_length] + "..."
+    if len(cleaned_text) > SANITIZE_MAX_LENGTH:
+        cleaned_text = cleaned_text[:SANITIZE_MAX_LENGTH] + "..."
         
     return cleaned_text
 
+_sanitize_short_text = functools.lru_cache(maxsize=SANITIZE_CACHE_SIZE)(_sanitize_text)
+
+TELEGRAM_MAX_MESSAGE_CHARS = 4096
+# Pause before resending a message unchanged; a longer retry_after skips the resend
+RESEND_DEFAULT_DELAY = 1.0
+RESEND_MAX_DELAY = 5.0
+
+def _resend_delay(error: Exception) -> Optional[float]:
+    """Seconds to wait before sending the same message again, or None if that can't succeed"""
+    if isinstance(error, apihelper.ApiTelegramException):
+        if error.error_code == 429:
+            parameters = (error.result_json or {}).get('parameters') or {}
+            retry_after = parameters.get('retry_after', RESEND_DEFAULT_DELAY)
+            return retry_after if retry_after <= RESEND_MAX_DELAY else None
+        if 400 <= error.error_code < 500:
+            # Telegram rejected the request itself
+            return None
+    return RESEND_DEFAULT_DELAY
+
+# Control characters (including newlines) removed from the plain-ASCII fallback message
+CONTROL_CHARS_RE = re.compile(r'[\x00-\x1f\x7f]')
+
 def safe_telegram_send(chat_id: int, message: str, parse_mode: Optional[str] = None, retry: bool = True) -> Optional[telebot.types.Message]:
     """Safely send a message to Telegram, handling potential API errors."""
     global bot
@@ -151,9 +220,18 @@ def safe_telegram_send(chat_id: int, message: str, parse_mode: Optional[str] = N
         print(f"Error sending Telegram message: {e}")
         
         if retry:
+            # Already-sanitized text fails for transient reasons, not its content: resend it as is
+            delay = _resend_delay(e)
+            if delay is not None and message.isascii() and len(message) <= TELEGRAM_MAX_MESSAGE_CHARS:
+                try:
+                    time.sleep(delay)
+                    return bot.send_message(chat_id, message)
+                except Exception as e2:
+                    print(f"Error resending Telegram message: {e2}")
+            
             try:
                 # Strip everything down to basic ASCII
-                ultra_safe_text = ''.join(c for c in message if 32 <= ord(c) <= 126)
+                ultra_safe_text = CONTROL_CHARS_RE.sub('', message.encode('ascii', 'ignore').decode('ascii'))
                 ultra_safe_text = ultra_safe_text[:1000]  # Very short message
                 return bot.send_message(chat_id, ultra_safe_text)
             except Exception as e2:
@@ -169,6 +247,97 @@ def safe_telegram_send(chat_id: int, message: str, parse_mode: Optional[str] = N
                     
         return None
 
+# Telegram accepts at most 10 items per media group and 50MB per uploaded file
+MEDIA_GROUP_MAX_ITEMS = 10
+TELEGRAM_MAX_FILE_BYTES = 50 * 1024 * 1024
+# telebot builds a media group's whole request body in memory, so only small files are grouped
+# (and a group's total size is capped); larger files go through the streaming send_file_via_telegram
+MEDIA_GROUP_MAX_FILE_BYTES = 2 * 1024 * 1024
+MEDIA_GROUP_MAX_BYTES = 8 * 1024 * 1024
+
+# Attachment uploads for a ticket run in parallel, kept under Telegram's ~30 messages/second limit
+TELEGRAM_UPLOAD_WORKERS = 4
+# How long a forward waits for its uploads; slower ones keep going in the background
+ATTACHMENT_UPLOAD_WAIT = 60
+TELEGRAM_MESSAGES_PER_SECOND = 25
+_upload_executor = ThreadPoolExecutor(max_workers=TELEGRAM_UPLOAD_WORKERS, thread_name_prefix="telegram-upload")
+
+
+class TokenBucket:
+    """Blocking token bucket allowing `rate` operations per second with bursts up to `rate`"""
+    
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens: float = 1) -> None:
+        """Wait until `tokens` operations are allowed"""
+        tokens = min(tokens, self.rate)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_upload_rate = TokenBucket(TELEGRAM_MESSAGES_PER_SECOND)
+
+# Sent straight to the Bot API so uploads stream from disk instead of being built in memory
+TELEGRAM_SEND_DOCUMENT_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendDocument"
+TELEGRAM_UPLOAD_TIMEOUT = (5, 300)
+UPLOAD_READ_BUFFER = 1024 * 1024
+
+class MultipartFileBody:
+    """
+    multipart/form-data body for a single file upload that reads the file as it is sent.
+    requests/telebot would otherwise build the whole body in memory first.
+    """
+    
+    def __init__(self, fields: Dict[str, str], file_field: str, file_path: str):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        
+        filename = os.path.basename(file_path).replace('"', '')
+        head = ''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        )
+        head = head.encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('ascii')
+        
+        # requests uses .len for Content-Length and then calls read() in blocks
+        file = open(file_path, 'rb', buffering=UPLOAD_READ_BUFFER)
+        self.len = len(head) + os.fstat(file.fileno()).st_size + len(tail)
+        self._parts = [io.BytesIO(head), file, io.BytesIO(tail)]
+    
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+    
+    def close(self) -> None:
+        for part in self._parts:
+            part.close()
+        self._parts = []
+
 def send_file_via_telegram(chat_id: int, file_path: str, caption: Optional[str] = None) -> bool:
     """Send a file to Telegram"""
     global bot
@@ -179,27 +348,43 @@ def send_file_via_telegram(chat_id: int, file_path: str, caption: Optional[str]
     try:
         print(f"Sending file to Telegram: {file_path}")
         
-        # Check if file exists
-        if not os.path.exists(file_path):
+        # Check the file exists and get its size with one stat call
+        try:
+            file_size = os.stat(file_path).st_size
+        except FileNotFoundError:
             print(f"❌ Error: File not found: {file_path}")
             return False
-            
-        # Get file size
-        file_size = os.path.getsize(file_path)
         print(f"File size: {file_size} bytes ({file_size/1024/1024:.2f} MB)")
         
         # Check if file is too large for Telegram (max 50MB)
-        if file_size > 50 * 1024 * 1024:
+        if file_size > TELEGRAM_MAX_FILE_BYTES:
             print(f"❌ Error: File too large for Telegram: {file_path} ({file_size} bytes)")
             safe_telegram_send(chat_id, f"⚠️ File is too large to send via Telegram: {os.path.basename(file_path)} ({file_size} bytes)")
             return False
         
         # Send file
         print(f"Opening file for sending: {file_path}")
-        with open(file_path, 'rb') as f:
+        fields = {"chat_id": str(chat_id)}
+        if caption:
+            fields["caption"] = caption
+        body = MultipartFileBody(fields, "document", file_path)
+        try:
             print(f"Calling Telegram API to send document...")
-            message = bot.send_document(chat_id, f, caption=caption)
-            print(f"Telegram API message_id: {message.message_id}")
+            _upload_rate.acquire()
+            response = _session.post(
+                TELEGRAM_SEND_DOCUMENT_URL,
+                data=body,
+                headers={"Content-Type": body.content_type},
+                timeout=TELEGRAM_UPLOAD_TIMEOUT
+            )
+        finally:
+            body.close()
+        
+        result = response.json()
+        if not result.get("ok"):
+            print(f"❌ Telegram API error sending document: {result.get('description')}")
+            return False
+        print(f"Telegram API message_id: {result['result']['message_id']}")
         
         print(f"✅ File successfully sent via Telegram: {file_path}")
         return True
@@ -210,6 +395,80 @@ def send_file_via_telegram(chat_id: int, file_path: str, caption: Optional[str]
         traceback.print_exc()
         return False
 
+def _send_single_attachment(chat_id: int, ticket_id: str, attachment: Dict) -> int:
+    """Upload one attachment; returns 1 if it was sent"""
+    caption = f"#{ticket_id} - {attachment['filename']}"
+    if send_file_via_telegram(chat_id, attachment['path'], caption):
+        return 1
+    print(f"❌ Failed to send attachment: {attachment['filename']}")
+    return 0
+
+def _send_attachment_group(chat_id: int, ticket_id: str, group: List[Dict]) -> int:
+    """Upload attachments as one media group, one by one if Telegram rejects it; returns how many were sent"""
+    try:
+        print(f"Sending {len(group)} attachment(s) for ticket #{ticket_id} as one media group")
+        with contextlib.ExitStack() as stack:
+            media = [
+                types.InputMediaDocument(
+                    stack.enter_context(open(attachment['path'], 'rb')),
+                    caption=f"#{ticket_id} - {attachment['filename']}"
+                )
+                for attachment in group
+            ]
+            _upload_rate.acquire(len(group))
+            bot.send_media_group(chat_id, media)
+        return len(group)
+    except Exception as e:
+        print(f"❌ Error sending media group, sending files one by one: {e}")
+        return sum(_send_single_attachment(chat_id, ticket_id, attachment) for attachment in group)
+
+def send_attachments_via_telegram(chat_id: int, ticket_id: str, attachments: List[Dict]) -> int:
+    """
+    Send a ticket's attachments, grouping up to 10 small documents per request.
+    Groups and single files upload in parallel, so they can appear in the chat in a different
+    order than in the email. Returns how many were sent within ATTACHMENT_UPLOAD_WAIT seconds.
+    """
+    global bot
+    
+    if not bot:
+        initialize_telegram()
+    
+    groups = []
+    group_bytes = 0
+    singles = []
+    for attachment in attachments or []:
+        file_path = attachment.get('path')
+        try:
+            file_size = os.stat(file_path).st_size if file_path else None
+        except FileNotFoundError:
+            file_size = None
+        if file_size is None:
+            print(f"❌ Attachment file not found: {file_path}")
+            continue
+        if file_size > MEDIA_GROUP_MAX_FILE_BYTES:
+            # Streamed on its own (send_file_via_telegram also reports files over Telegram's limit)
+            singles.append(attachment)
+            continue
+        if not groups or len(groups[-1]) >= MEDIA_GROUP_MAX_ITEMS or group_bytes + file_size > MEDIA_GROUP_MAX_BYTES:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(attachment)
+        group_bytes += file_size
+    
+    futures = []
+    for group in groups:
+        if len(group) == 1:
+            singles.extend(group)
+        else:
+            futures.append(_upload_executor.submit(_send_attachment_group, chat_id, ticket_id, group))
+    for attachment in singles:
+        futures.append(_upload_executor.submit(_send_single_attachment, chat_id, ticket_id, attachment))
+    
+    done, not_done = futures_wait(futures, timeout=ATTACHMENT_UPLOAD_WAIT)
+    if not_done:
+        print(f"⚠️ {len(not_done)} upload(s) for ticket #{ticket_id} still running after {ATTACHMENT_UPLOAD_WAIT}s, continuing in the background")
+    return sum(future.result() for future in done)
+
 def forward_to_telegram(ticket_id: str, from_email: str, subject: str, message: str, attachments: List[Dict] = None) -> None:
     """Forward a new ticket to Telegram"""
     global bot
@@ -232,12 +491,13 @@ def forward_to_telegram(ticket_id: str, from_email: str, subject: str, message:
     attachment_info = ""
     if attachments and len(attachments) > 0:
         print(f"Including information about {len(attachments)} attachment(s) in Telegram message")
-        attachment_info = f"\n📎 Attachments: {len(attachments)}\n"
+        attachment_lines = [f"\n📎 Attachments: {len(attachments)}"]
         for i, attachment in enumerate(attachments):
             attachment_name = attachment.get('filename', 'Unknown')
             attachment_type = attachment.get('content_type', 'unknown')
-            attachment_info += f"- {attachment_name} ({attachment_type})\n"
+            attachment_lines.append(f"- {attachment_name} ({attachment_type})")
             print(f"  Attachment {i+1}: {attachment_name} ({attachment_type})")
+        attachment_info = "\n".join(attachment_lines) + "\n"
     else:
         print("No attachments to include in Telegram message")
     
@@ -263,19 +523,8 @@ def forward_to_telegram(ticket_id: str, from_email: str, subject: str, message:
         # Send attachments if any
         if attachments and len(attachments) > 0:
             print(f"Sending {len(attachments)} attachment(s) to Telegram")
-            for i, attachment in enumerate(attachments):
-                file_path = attachment.get('path')
-                if file_path and os.path.exists(file_path):
-                    print(f"Sending attachment {i+1}/{len(attachments)}: {attachment['filename']}")
-                    caption = f"#{ticket_id} - {attachment['filename']}"
-                    success = send_file_via_telegram(TELEGRAM_CHAT_ID, file_path, caption)
-                    if success:
-                        print(f"✅ Attachment {i+1} sent successfully: {attachment['filename']}")
-                    else:
-                        print(f"❌ Failed to send attachment {i+1}: {attachment['filename']}")
-                else:
-                    print(f"❌ Attachment file not found: {file_path}")
-            print(f"Finished sending attachments for ticket #{ticket_id}")
+            sent = send_attachments_via_telegram(TELEGRAM_CHAT_ID, ticket_id, attachments)
+            print(f"Finished sending attachments for ticket #{ticket_id} ({sent}/{len(attachments)} sent)")
         else:
             print(f"No attachments to send for ticket #{ticket_id}")
     except Exception as e:
@@ -310,10 +559,9 @@ def forward_to_telegram_with_draft(ticket_id: str, from_email: str, subject: str
     # Add attachment info if any
     attachment_info = ""
     if attachments and len(attachments) > 0:
-        attachment_info = f"\n📎 Attachments: {len(attachments)}\n"
-        for attachment in attachments:
-            attachment_name = attachment.get('filename', 'Unknown')
-            attachment_info += f"- {attachment_name}\n"
+        attachment_lines = [f"\n📎 Attachments: {len(attachments)}"]
+        attachment_lines.extend(f"- {attachment.get('filename', 'Unknown')}" for attachment in attachments)
+        attachment_info = "\n".join(attachment_lines) + "\n"
     
     # Message with draft and confirmation options
     telegram_message = (
@@ -336,45 +584,196 @@ def forward_to_telegram_with_draft(ticket_id: str, from_email: str, subject: str
         
         # Send attachments if any
         if attachments and len(attachments) > 0:
-            for attachment in attachments:
-                file_path = attachment.get('path')
-                if file_path and os.path.exists(file_path):
-                    caption = f"#{ticket_id} - {attachment['filename']}"
-                    send_file_via_telegram(TELEGRAM_CHAT_ID, file_path, caption)
+            send_attachments_via_telegram(TELEGRAM_CHAT_ID, ticket_id, attachments)
     except Exception as e:
         print(f"❌ Error forwarding to Telegram: {e}")
         import traceback
         traceback.print_exc()
 
 
-def notify_filtered_email(from_email: str, subject: str, classification) -> None:
-    """Notify about a filtered (spam/promotion) email"""
-    global bot
-    
-    # Ensure the bot is initialized
-    if bot is None:
-        initialize_telegram()
+class TelegramBatcher:
+    """
+    Coalesce ticket forwards that arrive close together into a single Telegram message.
+    A lone ticket is forwarded as usual; a burst is sent as one digest with per-ticket buttons.
+    """
+    
+    MAX_BATCH_SIZE = 10  # Keep the digest and its inline keyboard within Telegram limits
+    
+    def __init__(self, delay: float = 1.0):
+        self.delay = delay
+        self._queue: List[Dict] = []
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+    
+    def enqueue(self, ticket_id: str, from_email: str, subject: str, message: str, attachments: List[Dict] = None) -> None:
+        """Queue a ticket for forwarding and arm the flush timer if needed"""
+        with self._lock:
+            self._queue.append({
+                "ticket_id": ticket_id,
+                "from_email": from_email,
+                "subject": subject,
+                "message": message,
+                "attachments": attachments
+            })
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def flush(self) -> None:
+        """Send everything queued so far"""
+        with self._lock:
+            batch, self._queue = self._queue, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        
+        if len(batch) == 1:
+            forward_to_telegram(**batch[0])
+            return
+        
+        for start in range(0, len(batch), self.MAX_BATCH_SIZE):
+            self._send_digest(batch[start:start + self.MAX_BATCH_SIZE])
     
+    def _send_digest(self, batch: List[Dict]) -> None:
+        """Send one summary message covering several tickets"""
+        global bot
+        
+        if bot is None:
+            initialize_telegram()
+        
+        lines = [f"🆕 {len(batch)} New Support Requests\n"]
+        keyboard = types.InlineKeyboardMarkup(row_width=2)
+        for item in batch:
+            ticket_id = item["ticket_id"]
+            message = item["message"]
+            message_preview = message[:100] + "..." if len(message) > 100 else message
+            attachment_count = len(item["attachments"] or [])
+            
+            lines.append(f"Ticket ID: `{ticket_id}`")
+            lines.append(f"From: {sanitize_telegram_markdown(item['from_email'])}")
+            lines.append(f"Subject: {sanitize_telegram_markdown(item['subject'])}")
+            if attachment_count:
+                lines.append(f"📎 Attachments: {attachment_count}")
+            lines.append(f"{sanitize_telegram_markdown(message_preview)}\n")
+            
+            keyboard.add(
+                types.InlineKeyboardButton(f"📝 Reply {ticket_id}", callback_data=f"reply:{ticket_id}"),
+                types.InlineKeyboardButton("📋 Details", callback_data=f"details:{ticket_id}")
+            )
+        
+        try:
+            print(f"Sending digest of {len(batch)} tickets to Telegram")
+            bot.send_message(TELEGRAM_CHAT_ID, "\n".join(lines), reply_markup=keyboard)
+        except Exception as e:
+            print(f"❌ Error sending ticket digest to Telegram: {e}")
+            import traceback
+            traceback.print_exc()
+            return
+        
+        for item in batch:
+            ticket_id = item["ticket_id"]
+            update_ticket_status(ticket_id, "forwarded_to_support")
+            if item["attachments"]:
+                send_attachments_via_telegram(TELEGRAM_CHAT_ID, ticket_id, item["attachments"])
+        print(f"✅ Forwarded {len(batch)} tickets to Telegram")
+
+
+# Shared batcher used for plain ticket forwards
+telegram_batcher = TelegramBatcher()
+
+
+class FilteredEmailBatcher:
+    """
+    Collect filtered-email notices for a couple of seconds and send them as one message,
+    so a spam wave doesn't flood the chat with one message per email.
+    """
+    
+    MAX_BATCH_SIZE = 10
+    MAX_MESSAGE_CHARS = 3500  # Stay well under Telegram's 4096-character message limit
+    
+    def __init__(self, delay: float = 2.0):
+        self.delay = delay
+        self._queue: List[str] = []
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+    
+    def enqueue(self, entry: str) -> None:
+        """Queue one notice; sends right away once the batch is full"""
+        batches = []
+        with self._lock:
+            if self._queue and self._chars + len(entry) > self.MAX_MESSAGE_CHARS:
+                batches.append(self._take())
+            self._queue.append(entry)
+            self._chars += len(entry)
+            if len(self._queue) >= self.MAX_BATCH_SIZE:
+                batches.append(self._take())
+            elif self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        
+        for batch in batches:
+            self._send(batch)
+    
+    def flush(self) -> None:
+        """Send everything queued so far"""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+    
+    def _take(self) -> List[str]:
+        """Empty the queue and disarm the timer (caller holds the lock)"""
+        batch, self._queue, self._chars = self._queue, [], 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+    
+    def _send(self, batch: List[str]) -> None:
+        if len(batch) == 1:
+            message = f"🗑️ Email Filtered\n{batch[0]}"
+        else:
+            message = f"🗑️ {len(batch)} Emails Filtered\n\n" + "\n\n".join(batch)
+        
+        try:
+            safe_telegram_send(TELEGRAM_CHAT_ID, message)
+        except Exception as e:
+            print(f"Error notifying about filtered email: {e}")
+
+
+# Shared batcher for filtered-email notices
+filtered_email_batcher = FilteredEmailBatcher()
+
+
+def notify_filtered_email(from_email: str, subject: str, classification) -> None:
+    """Notify about a filtered (spam/promotion) email (sent batched with others arriving close together)"""
     safe_from_email = sanitize_telegram_markdown(from_email)
     safe_subject = sanitize_telegram_markdown(subject[:100])
     
-    message = (
-        f"🗑️ Email Filtered\n"
+    entry = (
         f"From: {safe_from_email}\n"
         f"Subject: {safe_subject}\n"
         f"Category: {classification.category.value}\n"
         f"Confidence: {classification.confidence:.0%}\n"
         f"Reason: {classification.reason}"
     )
-    
-    try:
-        safe_telegram_send(TELEGRAM_CHAT_ID, message)
-    except Exception as e:
-        print(f"Error notifying about filtered email: {e}")
+    filtered_email_batcher.enqueue(entry)
+
+# Seconds Telegram holds a getUpdates request open while waiting for new updates
+# (kept below cleanup()'s 5 second join, so the loop has stopped by the time the process exits)
+TELEGRAM_LONG_POLL_TIMEOUT = 4
+# Only the update types the handlers deal with
+TELEGRAM_ALLOWED_UPDATES = ["message", "callback_query"]
+# Wait after a failed poll, doubling on each consecutive failure
+POLL_ERROR_BACKOFF_START = 0.5
+POLL_ERROR_BACKOFF_MAX = 8.0
 
 def telegram_polling_loop():
     """Main Telegram polling loop"""
-    global bot, running
+    global bot
     
     # First, make sure any existing webhook is removed
     try:
@@ -385,38 +784,49 @@ def telegram_polling_loop():
     
     print("Starting Telegram polling loop...")
     
+    # Updates below this ID have been handled; passing it to the next poll acknowledges them
+    offset = 0
+    backoff = POLL_ERROR_BACKOFF_START
+    
     # Main polling loop
-    while running:
+    while not _stop_polling.is_set():
         try:
-            # Get updates with a short timeout
-            updates = bot.get_updates(offset=0, timeout=2)
+            # Long poll: Telegram answers as soon as an update arrives
+            updates = bot.get_updates(
+                offset=offset,
+                timeout=TELEGRAM_LONG_POLL_TIMEOUT,
+                long_polling_timeout=TELEGRAM_LONG_POLL_TIMEOUT,
+                allowed_updates=TELEGRAM_ALLOWED_UPDATES
+            )
+            backoff = POLL_ERROR_BACKOFF_START
             
             # Process each update
-            if updates:
-                for update in updates:
-                    try:
-                        bot.process_new_updates([update])
-                        # Update the offset to acknowledge this update
-                        offset = update.update_id + 1
-                        bot.get_updates(offset=offset)
-                    except Exception as e:
-                        print(f"Error processing update: {e}")
-            
-            # Short sleep to prevent CPU overuse
-            time.sleep(1)
+            for update in updates:
+                offset = update.update_id + 1
+                try:
+                    bot.process_new_updates([update])
+                except Exception as e:
+                    print(f"Error processing update: {e}")
             
         except Exception as e:
             print(f"Error in Telegram polling loop: {e}")
-            # If there's an error, wait a bit before retrying
-            time.sleep(5)
+            # If there's an error, wait a bit before retrying (returns at once on shutdown)
+            if _stop_polling.wait(backoff):
+                break
+            backoff = min(backoff * 2, POLL_ERROR_BACKOFF_MAX)
             
-            # Try to reset the bot
-            try:
-                bot.remove_webhook()
-            except:
-                pass 
+            # getUpdates is refused while a webhook is set; other errors are transient
+            if isinstance(e, apihelper.ApiTelegramException) and "webhook" in str(e).lower():
+                try:
+                    bot.remove_webhook()
+                except Exception as e2:
+                    print(f"Error removing webhook: {e2}")
 
 def set_running_state(state: bool):
     """Set the running state for the Telegram polling loop"""
     global running
-    running = state 
\ No newline at end of file
+    running = state
+    if state:
+        _stop_polling.clear()
+    else:
+        _stop_polling.set() 
\ No newline at end of file